@@ -0,0 +1,173 @@
+"""Asyncio client for the Asana endpoints used by experisana.
+
+All requests of a client share one aiohttp connection pool, and failed requests
+(429, 5xx, connection errors) are retried with exponential backoff, honoring
+Retry-After. This lets one process keep many requests in flight without threads:
+
+    async with AsyncAsanaClient() as client:
+        tasks = await asyncio.gather(*[client.get_task(gid) for gid in gids])
+"""
+import os
+import random
+import asyncio
+import time
+import aiohttp
+from dotenv import load_dotenv
+from experisana.metrics import record_api_call, inc, endpoint_label
+
+load_dotenv(override=True)
+
+ACCESS_TOKEN = os.getenv("ASANA_ACCESS_TOKEN")
+BASE_URL = "https://app.asana.com/api/1.0"
+
+
+class AsanaRequestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+
+
+class AsyncAsanaClient:
+    def __init__(self, access_token=None, max_connections=50, max_tries=8, max_backoff_seconds=60):
+        self.access_token = access_token or ACCESS_TOKEN
+        self.max_connections = max_connections
+        self.max_tries = max_tries
+        self.max_backoff_seconds = max_backoff_seconds
+        self.session = None
+        self.download_session = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.max_connections)
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            headers={"Authorization": f"Bearer {self.access_token}", "Accept": "application/json"},
+        )
+        # Attachment downloads go to pre-signed URLs that must not get the Asana token
+        self.download_session = aiohttp.ClientSession(connector=connector, connector_owner=False)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.download_session.close()
+        await self.session.close()
+
+    async def _sleep_before_retry(self, attempt, retry_after=None):
+        if retry_after is not None:
+            delay = float(retry_after)
+        else:
+            delay = min(self.max_backoff_seconds, 2 ** attempt) * random.random()
+        await asyncio.sleep(delay)
+
+    async def request(self, method, path, params=None, data=None, form=None, raw=False):
+        """Send a request and return the `data` field of the response (or the full response if raw)"""
+        endpoint = endpoint_label(method, path)
+        for attempt in range(self.max_tries):
+            if attempt > 0:
+                inc("experisana_api_retries_total", function=endpoint)
+            start = time.time()
+            try:
+                kwargs = {'params': params}
+                if form is not None:
+                    kwargs['data'] = form()
+                elif data is not None:
+                    kwargs['json'] = {"data": data}
+                async with self.session.request(method, f"{BASE_URL}{path}", **kwargs) as response:
+                    record_api_call(endpoint, time.time() - start, response.status)
+                    if response.status == 429 or response.status >= 500:
+                        if attempt == self.max_tries - 1:
+                            raise AsanaRequestError(response.status, await response.text())
+                        await self._sleep_before_retry(attempt, response.headers.get("Retry-After"))
+                        continue
+                    if response.status >= 400:
+                        raise AsanaRequestError(response.status, await response.text())
+                    body = await response.json()
+                    return body if raw else body.get('data')
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                record_api_call(endpoint, time.time() - start, type(e).__name__)
+                if attempt == self.max_tries - 1:
+                    raise
+                print(f"Retrying {method} {path} after error: {e}")
+                await self._sleep_before_retry(attempt)
+
+    async def paginate(self, path, params=None):
+        """GET all pages of a collection endpoint"""
+        params = {'limit': 100, **(params or {})}
+        items = []
+        while True:
+            body = await self.request("GET", path, params=params, raw=True)
+            items += body.get('data', [])
+            next_page = body.get('next_page')
+            if not next_page:
+                return items
+            params = {**params, 'offset': next_page['offset']}
+
+    # Tasks
+    async def get_task(self, task_gid, opt_fields=None):
+        return await self.request("GET", f"/tasks/{task_gid}", params=opt_fields and {'opt_fields': opt_fields})
+
+    async def get_tasks(self, params):
+        return await self.paginate("/tasks", params)
+
+    async def create_task(self, data):
+        return await self.request("POST", "/tasks", data=data)
+
+    async def update_task(self, task_gid, data):
+        return await self.request("PUT", f"/tasks/{task_gid}", data=data)
+
+    async def delete_task(self, task_gid):
+        return await self.request("DELETE", f"/tasks/{task_gid}")
+
+    # Sections
+    async def get_sections_for_project(self, project_gid):
+        return await self.paginate(f"/projects/{project_gid}/sections")
+
+    async def get_tasks_for_section(self, section_gid, opt_fields=None):
+        return await self.paginate(f"/sections/{section_gid}/tasks", opt_fields and {'opt_fields': opt_fields})
+
+    async def add_task_to_section(self, section_gid, task_gid):
+        return await self.request("POST", f"/sections/{section_gid}/addTask", data={"task": task_gid})
+
+    # Stories
+    async def create_story(self, task_gid, text):
+        return await self.request("POST", f"/tasks/{task_gid}/stories", data={"text": text})
+
+    # Attachments
+    async def get_attachments(self, parent_gid, opt_fields="name,download_url,created_at"):
+        return await self.paginate("/attachments", {'parent': parent_gid, 'opt_fields': opt_fields})
+
+    async def get_attachment(self, attachment_gid, opt_fields="name,download_url,created_at"):
+        return await self.request("GET", f"/attachments/{attachment_gid}", params={'opt_fields': opt_fields})
+
+    async def upload_attachment(self, parent_gid, file_path):
+        def form():
+            form = aiohttp.FormData()
+            form.add_field("resource_subtype", "asana")
+            form.add_field("parent", str(parent_gid))
+            form.add_field("file", open(file_path, "rb"), filename=os.path.basename(file_path))
+            return form
+        return await self.request("POST", "/attachments", form=form)
+
+    async def download(self, url, file_path, chunk_size=1024 * 1024):
+        """Download a (pre-signed) attachment URL"""
+        for attempt in range(self.max_tries):
+            try:
+                async with self.download_session.get(url) as response:
+                    response.raise_for_status()
+                    with open(file_path, "wb") as f:
+                        async for chunk in response.content.iter_chunked(chunk_size):
+                            f.write(chunk)
+                    return file_path
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == self.max_tries - 1:
+                    raise
+                print(f"Retrying download of {file_path} after error: {e}")
+                await self._sleep_before_retry(attempt)
+
+    # Tags
+    async def get_tags_for_workspace(self, workspace_gid):
+        return await self.paginate(f"/workspaces/{workspace_gid}/tags", {'opt_fields': 'name'})
+
+    async def create_tag(self, data):
+        return await self.request("POST", "/tags", data=data)
+
+    async def add_tag(self, task_gid, tag_gid):
+        return await self.request("POST", f"/tasks/{task_gid}/addTag", data={"tag": tag_gid})
@@ -0,0 +1,267 @@
+"""Pack a task's uploads/ directory into a few compressed tar archives.
+
+Attaching every file separately costs one upload per file, and one API call plus
+one download per file on `pull`. With `uploads.archive` enabled, the worker
+instead streams all files into tar archives (zstd if the `zstandard` package is
+installed, gzip otherwise) of about `chunk_mb` each, and attaches them with a
+manifest:
+
+    uploads.manifest.json
+    uploads.000.tar.zst
+    uploads.001.tar.zst
+
+Each archive can be extracted on its own, and the manifest records which file
+is in which archive, so selective pulls only download the archives they need.
+A single file that is larger than `chunk_mb` makes its archive larger than the
+attachment size limit; such archives are split into `.partNNN` pieces.
+"""
+import os
+import json
+import tarfile
+import fnmatch
+from typing import Dict, List, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MANIFEST_SUFFIX = ".manifest.json"
+EXTENSIONS = {'zstd': 'tar.zst', 'gzip': 'tar.gz'}
+
+
+def get_archive_settings(config: Dict) -> Dict:
+    """Normalize the `uploads` section of experisana.yaml:
+        uploads:
+          archive: true
+          compression: zstd # or gzip
+          chunk_mb: 90
+    """
+    uploads = config.get('uploads') or {}
+    compression = uploads.get('compression', 'zstd')
+    if compression == 'zstd' and zstandard is None:
+        compression = 'gzip'
+    return {
+        'archive': uploads.get('archive', False),
+        'compression': compression,
+        'chunk_mb': uploads.get('chunk_mb', 90),
+    }
+
+
+class ChunkWriter:
+    """Write-only file object that starts a new .partNNN file every max_bytes"""
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.parts = []
+        self.size = 0
+        self._file = None
+        self._written = 0
+
+    def _next_part(self):
+        if self._file is not None:
+            self._file.close()
+        self.parts.append(f"{self.path}.part{len(self.parts):03d}")
+        self._file = open(self.parts[-1], "wb")
+        self._written = 0
+
+    def write(self, data):
+        view = memoryview(data)
+        while len(view):
+            if self._file is None or self._written >= self.max_bytes:
+                self._next_part()
+            n = min(len(view), self.max_bytes - self._written)
+            self._file.write(view[:n])
+            self._written += n
+            self.size += n
+            view = view[n:]
+        return len(data)
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        """Close the last part, and drop the .part000 suffix if there is only one part"""
+        if self._file is None:
+            self._next_part()
+        self._file.close()
+        if len(self.parts) == 1:
+            os.replace(self.parts[0], self.path)
+            self.parts = [self.path]
+        return self.parts
+
+
+class ChunkReader:
+    """Read-only file object over the concatenated parts of an archive"""
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self._file = None
+
+    def read(self, n=-1):
+        chunks = []
+        while n != 0:
+            if self._file is None:
+                if not self.paths:
+                    break
+                self._file = open(self.paths.pop(0), "rb")
+            data = self._file.read(n)
+            if not data:
+                self._file.close()
+                self._file = None
+                continue
+            chunks.append(data)
+            if n > 0:
+                n -= len(data)
+        return b"".join(chunks)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+class ArchiveWriter:
+    """One streamed tar archive, compressed with zstd or gzip and split into parts"""
+
+    def __init__(self, path, compression, max_bytes):
+        self.chunks = ChunkWriter(path, max_bytes)
+        if compression == 'zstd':
+            self.compressor = zstandard.ZstdCompressor().stream_writer(self.chunks, closefd=False)
+            self.tar = tarfile.open(fileobj=self.compressor, mode="w|")
+        else:
+            self.compressor = None
+            self.tar = tarfile.open(fileobj=self.chunks, mode="w|gz")
+
+    def close(self):
+        self.tar.close()
+        if self.compressor is not None:
+            self.compressor.close()
+        return self.chunks.close()
+
+
+def pack_directory(src_dir, out_dir, name="uploads", compression="gzip", chunk_mb=90) -> List[str]:
+    """Pack all files below src_dir into archives in out_dir and write the manifest.
+    Returns the paths to attach: the manifest first, then all archive parts."""
+    os.makedirs(out_dir, exist_ok=True)
+    max_bytes = int(chunk_mb * 1024 * 1024)
+    manifest = {'name': name, 'compression': compression, 'archives': [], 'files': []}
+
+    def open_archive():
+        return ArchiveWriter(os.path.join(out_dir, f"{name}.{len(manifest['archives']):03d}.{EXTENSIONS[compression]}"), compression, max_bytes)
+
+    def close_archive(writer):
+        parts = writer.close()
+        manifest['archives'].append({'parts': [os.path.basename(p) for p in parts], 'bytes': writer.chunks.size})
+        return parts
+
+    paths, writer = [], None
+    for root, dirs, files in os.walk(src_dir):
+        dirs.sort()
+        for file in sorted(files):
+            file_path = os.path.join(root, file)
+            # Start the next archive once the current one reached the chunk size (measured after compression)
+            if writer is not None and writer.chunks.size >= max_bytes:
+                paths += close_archive(writer)
+                writer = None
+            if writer is None:
+                writer = open_archive()
+            arcname = os.path.relpath(file_path, src_dir)
+            writer.tar.add(file_path, arcname=arcname, recursive=False)
+            manifest['files'].append({'path': arcname, 'size': os.path.getsize(file_path), 'archive': len(manifest['archives'])})
+    if writer is not None:
+        paths += close_archive(writer)
+
+    manifest_path = os.path.join(out_dir, f"{name}{MANIFEST_SUFFIX}")
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    return [manifest_path] + paths
+
+
+def load_manifest(manifest_path) -> Dict:
+    with open(manifest_path, "r") as f:
+        return json.load(f)
+
+
+def read_manifest(manifest_path) -> Optional[Dict]:
+    """The manifest at manifest_path, or None if the file is not a manifest written by pack_directory
+    (e.g. a JSON file the job itself uploaded)"""
+    try:
+        manifest = load_manifest(manifest_path)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(manifest, dict) or not {'name', 'compression', 'archives', 'files'} <= set(manifest):
+        return None
+    if manifest['compression'] not in EXTENSIONS or os.path.basename(manifest_path) != f"{manifest['name']}{MANIFEST_SUFFIX}":
+        return None
+    return manifest
+
+
+def matches(path, include: Optional[List[str]]) -> bool:
+    """Whether a file in the archive matches any of the glob patterns (everything matches without patterns)"""
+    if not include:
+        return True
+    return any(fnmatch.fnmatch(path, pattern) or path.startswith(pattern.rstrip("/") + "/") for pattern in include)
+
+
+def needed_parts(manifest: Dict, include: Optional[List[str]] = None) -> List[str]:
+    """Attachment names of the archive parts that contain files matching include"""
+    archives = sorted({entry['archive'] for entry in manifest['files'] if matches(entry['path'], include)})
+    return [part for i in archives for part in manifest['archives'][i]['parts']]
+
+
+def all_parts(manifest: Dict) -> List[str]:
+    return [part for archive in manifest['archives'] for part in archive['parts']]
+
+
+def _is_safe(member, dest_dir):
+    target = os.path.realpath(os.path.join(dest_dir, member.name))
+    return (member.isfile() or member.isdir()) and target.startswith(os.path.realpath(dest_dir) + os.sep)
+
+
+def unpack(manifest_path, dest_dir, include: Optional[List[str]] = None, remove_parts=True) -> List[str]:
+    """Extract the files matching include from the archives next to manifest_path into dest_dir.
+    Returns the extracted paths. Archive parts are deleted afterwards unless remove_parts is False."""
+    manifest = read_manifest(manifest_path)
+    if manifest is None:
+        return []
+    archive_dir = os.path.dirname(manifest_path)
+    extracted = []
+    for i, archive in enumerate(manifest['archives']):
+        if not any(entry['archive'] == i and matches(entry['path'], include) for entry in manifest['files']):
+            continue
+        part_paths = [os.path.join(archive_dir, part) for part in archive['parts']]
+        missing = [p for p in part_paths if not os.path.exists(p)]
+        if missing:
+            print(f"Warning: missing archive parts {missing}. Skipping.")
+            continue
+        reader = ChunkReader(part_paths)
+        stream = zstandard.ZstdDecompressor().stream_reader(reader) if manifest['compression'] == 'zstd' else reader
+        with tarfile.open(fileobj=stream, mode="r|" if manifest['compression'] == 'zstd' else "r|gz") as tar:
+            for member in tar:
+                if not matches(member.name, include):
+                    continue
+                if not _is_safe(member, dest_dir):
+                    print(f"Warning: skipping unsafe archive member {member.name}")
+                    continue
+                tar.extract(member, dest_dir)
+                extracted.append(os.path.join(dest_dir, member.name))
+        reader.close()
+        if remove_parts:
+            for p in part_paths:
+                os.remove(p)
+    return extracted
+
+
+def unpack_all(directory, include: Optional[List[str]] = None) -> List[str]:
+    """Unpack every archive whose manifest was downloaded into directory"""
+    extracted = []
+    for file in sorted(os.listdir(directory)):
+        if not file.endswith(MANIFEST_SUFFIX):
+            continue
+        try:
+            extracted += unpack(os.path.join(directory, file), directory, include)
+        except Exception as e:
+            print(f"Warning: could not unpack the archives of {file}: {e}")
+    return extracted
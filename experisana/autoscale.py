@@ -1,6 +1,5 @@
 import os
 import time
-import random
 import subprocess
 import yaml
 from dotenv import load_dotenv
@@ -10,6 +9,8 @@ import backoff
 from experisana.worker import (
     PROJECT_GID,
     column_gids,
+    get_projects,
+    get_project_columns,
     tasks_api_instance,
     stories_api_instance,
     CONFIG,
@@ -17,18 +18,25 @@ from experisana.worker import (
     move_task_to_column,
     upload_log_to_task
 )
+from experisana.metrics import inc, set_gauge, count_retry, start_metrics_server
+from experisana.policy import should_scale_up, scale_wait_seconds
 
-@backoff.on_exception(backoff.expo, ApiException, max_tries=5)
-def count_available_tasks():
-    tasks = tasks_api_instance.get_tasks_for_section(column_gids["Backlog"], {"limit": 100})
+@backoff.on_exception(backoff.expo, ApiException, max_tries=5, on_backoff=count_retry)
+def count_available_tasks(backlog_column_gid=None):
+    tasks = tasks_api_instance.get_tasks_for_section(backlog_column_gid or column_gids["Backlog"], {"limit": 100})
     return len(list(tasks))
 
-@backoff.on_exception(backoff.expo, ApiException, max_tries=5)
+def count_combined_backlog(projects):
+    """Backlog tasks of all projects the pool serves, per project and in total"""
+    backlogs = {project['gid']: count_available_tasks(get_project_columns(project['gid'])["Backlog"]) for project in projects}
+    return backlogs, sum(backlogs.values())
+
+@backoff.on_exception(backoff.expo, ApiException, max_tries=5, on_backoff=count_retry)
 def count_active_workers():
     tasks = tasks_api_instance.get_tasks_for_section(column_gids["Active Workers"], {"limit": 100})
     return len(list(tasks))
 
-@backoff.on_exception(backoff.expo, ApiException, max_tries=5)
+@backoff.on_exception(backoff.expo, ApiException, max_tries=5, on_backoff=count_retry)
 def create_worker_task(worker_id):
     task_data = {
         "data": {
@@ -40,7 +48,7 @@ def create_worker_task(worker_id):
     }
     return tasks_api_instance.create_task(task_data, opts)
 
-@backoff.on_exception(backoff.expo, ApiException, max_tries=5)
+@backoff.on_exception(backoff.expo, ApiException, max_tries=5, on_backoff=count_retry)
 def post_comment_to_task(task_gid, comment_text):
     if len(comment_text) > 2000:
         with open(f'/tmp/logs-{task_gid}', 'w') as f:
@@ -65,6 +73,7 @@ def scale_up():
         status = 'failed'
         output = e.stderr
         target_column = column_gids["Failed"]
+    inc("experisana_scale_ups_total", status=status)
 
     comment_text = f"Scale up {status}. Logs:\n```\n{output}\n```"
     post_comment_to_task(task['gid'], comment_text)
@@ -72,15 +81,23 @@ def scale_up():
     # Move the task to the appropriate column (Done or Failed)
     move_task_to_column(task['gid'], target_column)
 
-def autoscale():
+def autoscale(metrics_port=None, projects=None):
+    """Start workers while there are more backlog tasks (across all projects the workers serve) than active workers"""
+    metrics_port = metrics_port or CONFIG.get('metrics', {}).get('port')
+    if metrics_port:
+        start_metrics_server(metrics_port)
+    projects = get_projects(projects)
     while True:
-        available_tasks = count_available_tasks()
+        backlogs, available_tasks = count_combined_backlog(projects)
         active_workers = count_active_workers()
+        for project_gid, backlog in backlogs.items():
+            set_gauge("experisana_project_backlog_tasks", backlog, project=project_gid)
+        set_gauge("experisana_backlog_tasks", available_tasks)
+        set_gauge("experisana_active_workers", active_workers)
         
-        if active_workers < CONFIG['scale']['max'] and available_tasks > active_workers:
+        if should_scale_up(available_tasks, active_workers, CONFIG['scale']['max']):
             scale_up()
-            wait_time = random.randint(0, CONFIG['scale'].get('wait_between_scales_min', 1) * 60)
-            time.sleep(wait_time)
+            time.sleep(scale_wait_seconds(CONFIG['scale']))
         else:
             time.sleep(5)
 
@@ -0,0 +1,277 @@
+"""Per-host index of the models this machine has cached on disk.
+
+Workers prefer tasks whose models are already cached, because loading a model
+from scratch can take many minutes. The index lives next to `~/worker_id`,
+is checked against the actual cache directories (e.g. the HF hub cache) and
+bounded via LRU eviction, which also deletes the evicted models from disk.
+All workers of a host share the index: it is re-read and updated under a file
+lock, and models that a running task uses are never evicted.
+"""
+import os
+import json
+import time
+import fcntl
+import shutil
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+CACHE_INDEX_PATH = os.path.expanduser("~/.experisana/cache_index.json")
+CACHE_LOCK_PATH = f"{CACHE_INDEX_PATH}.lock"
+# Used to estimate the load cost of cached models we have never seen being loaded
+ASSUMED_LOAD_BYTES_PER_SECOND = 100 * 1024 * 1024
+
+_index = None
+# Serializes access to _index between the threads of a worker, the file lock between workers
+_lock = threading.RLock()
+
+
+def default_cache_dirs() -> List[str]:
+    if os.getenv("HF_HUB_CACHE"):
+        return [os.getenv("HF_HUB_CACHE")]
+    if os.getenv("HF_HOME"):
+        return [os.path.join(os.getenv("HF_HOME"), "hub")]
+    return ["~/.cache/huggingface/hub"]
+
+
+def get_cache_settings(config: Dict) -> Dict:
+    """Normalize the `cache` section of experisana.yaml.
+
+    It can either be a list of context keys (e.g. [base_model, model_id]), or a dict:
+        cache:
+          keys: [base_model, model_id]
+          dirs: [~/.cache/huggingface/hub]
+          max_entries: 20
+          max_gb: 500
+    Without max_entries/max_gb, nothing is ever evicted.
+    """
+    cache = config.get('cache') or {}
+    if isinstance(cache, list):
+        cache = {'keys': cache}
+    elif 'keys' not in cache and all(isinstance(v, list) for v in cache.values()):
+        # Legacy format: {key: [seen values]}
+        cache = {'keys': list(cache.keys())}
+    return {
+        'keys': cache.get('keys', ['base_model', 'model_id']),
+        'dirs': [os.path.expanduser(d) for d in cache.get('dirs', default_cache_dirs())],
+        'max_entries': cache.get('max_entries', None),
+        'max_gb': cache.get('max_gb', None),
+    }
+
+
+def read_index() -> Dict:
+    index = {'entries': {}, 'hits': 0, 'misses': 0, 'in_use': {}}
+    if os.path.exists(CACHE_INDEX_PATH):
+        try:
+            with open(CACHE_INDEX_PATH, "r") as f:
+                index.update(json.load(f))
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"Ignoring unreadable cache index {CACHE_INDEX_PATH}: {e}")
+    return index
+
+
+def load_index() -> Dict:
+    global _index
+    if _index is None:
+        _index = read_index()
+    return _index
+
+
+@contextmanager
+def locked_index():
+    """Re-read the index under an exclusive lock, so that updates of other workers on this host are kept, and save it"""
+    global _index
+    os.makedirs(os.path.dirname(CACHE_INDEX_PATH), exist_ok=True)
+    with _lock, open(CACHE_LOCK_PATH, "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            _index = read_index()
+            yield _index
+            save_index()
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def save_index():
+    os.makedirs(os.path.dirname(CACHE_INDEX_PATH), exist_ok=True)
+    tmp_path = f"{CACHE_INDEX_PATH}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(load_index(), f, indent=2)
+    os.replace(tmp_path, CACHE_INDEX_PATH)
+
+
+def entry_id(key: str, value: str) -> str:
+    return f"{key}={value}"
+
+
+def find_cache_paths(value, dirs: List[str]) -> List[str]:
+    """Paths inside the cache directories that belong to `value`, e.g. models--org--name for the HF hub"""
+    if not isinstance(value, str) or not value or '..' in value or os.path.isabs(value):
+        return []
+    paths = []
+    for cache_dir in dirs:
+        root = os.path.realpath(cache_dir)
+        for candidate in [f"models--{value.replace('/', '--')}", value]:
+            path = os.path.realpath(os.path.join(root, candidate))
+            # Only direct children of a cache directory, since evicted entries are deleted from disk
+            if os.path.dirname(path) == root and os.path.exists(path) and path not in paths:
+                paths.append(path)
+    return paths
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def mark_in_use(index: Dict, eids: List[str], delta: int):
+    """Count the running tasks of this process that use each entry, and drop processes that exited"""
+    pid = str(os.getpid())
+    for eid in eids:
+        users = index['in_use'].setdefault(eid, {})
+        users[pid] = users.get(pid, 0) + delta
+        if users[pid] <= 0:
+            users.pop(pid)
+    for eid, users in list(index['in_use'].items()):
+        for user in [user for user in users if not pid_alive(int(user))]:
+            users.pop(user)
+        if not users:
+            index['in_use'].pop(eid)
+
+
+def task_entry_ids(task_context: Optional[Dict], settings: Dict) -> List[str]:
+    if not task_context:
+        return []
+    return [entry_id(key, task_context[key]) for key in settings['keys'] if key in task_context]
+
+
+def disk_usage(paths: List[str]) -> Tuple[int, float]:
+    """Returns (total bytes, newest mtime) of all files below paths"""
+    size, newest = 0, 0.0
+    for path in paths:
+        for root, dirs, files in os.walk(path):
+            for file in files:
+                try:
+                    stat = os.stat(os.path.join(root, file))
+                except OSError:
+                    continue
+                size += stat.st_size
+                newest = max(newest, stat.st_mtime)
+    return size, newest
+
+
+def get_entry(key: str, value, settings: Dict) -> Optional[Dict]:
+    """Index entry for key=value if the model is on disk, adopting models that were cached by someone else"""
+    entries = load_index()['entries']
+    eid = entry_id(key, value)
+    paths = find_cache_paths(value, settings['dirs'])
+    if not paths:
+        entries.pop(eid, None)
+        return None
+    if eid not in entries:
+        size, _ = disk_usage(paths)
+        entries[eid] = {
+            'key': key,
+            'value': value,
+            'paths': paths,
+            'size_bytes': size,
+            'load_seconds': None,
+            'last_used': 0,
+        }
+    entries[eid]['paths'] = paths
+    return entries[eid]
+
+
+def load_cost(entry: Dict) -> float:
+    """Seconds we expect to save by running a task that needs this entry on this host"""
+    if entry.get('load_seconds'):
+        return entry['load_seconds']
+    return max(1.0, entry.get('size_bytes', 0) / ASSUMED_LOAD_BYTES_PER_SECOND)
+
+
+def calculate_cache_score(task_context: Optional[Dict], settings: Dict) -> float:
+    """Sum of the load costs of all models of the task that are cached on this host."""
+    if not task_context:
+        return 0
+    score = 0
+    with _lock:
+        for key in settings['keys']:
+            if key in task_context:
+                entry = get_entry(key, task_context[key], settings)
+                if entry is not None:
+                    score += load_cost(entry)
+    return score
+
+
+def lookup_cache(task_context: Optional[Dict], settings: Dict) -> Tuple[List[str], List[str]]:
+    """Record cache hits and misses for a task that is about to run, and mark its models as in use
+    until record_cache_usage is called."""
+    if not task_context:
+        return [], []
+    hits, misses = [], []
+    with locked_index() as index:
+        for key in settings['keys']:
+            if key not in task_context:
+                continue
+            if get_entry(key, task_context[key], settings) is not None:
+                hits.append(entry_id(key, task_context[key]))
+            else:
+                misses.append(entry_id(key, task_context[key]))
+        index['hits'] += len(hits)
+        index['misses'] += len(misses)
+        mark_in_use(index, hits + misses, 1)
+    print(f"Cache hits: {hits}, misses: {misses} (total: {index['hits']} hits, {index['misses']} misses)")
+    return hits, misses
+
+
+def record_cache_usage(task_context: Optional[Dict], settings: Dict, started_at: float, misses: List[str]):
+    """Update the index after a task ran: refresh sizes, measure load costs of new models, release them and evict."""
+    if not task_context:
+        return
+    used = []
+    with locked_index() as index:
+        mark_in_use(index, task_entry_ids(task_context, settings), -1)
+        for key in settings['keys']:
+            if key not in task_context:
+                continue
+            entry = get_entry(key, task_context[key], settings)
+            if entry is None:
+                continue
+            eid = entry_id(key, task_context[key])
+            used.append(eid)
+            entry['size_bytes'], newest_mtime = disk_usage(entry['paths'])
+            if eid in misses and newest_mtime > started_at:
+                # The model was downloaded by this task - the time until the last file was written is its load cost
+                entry['load_seconds'] = max(1.0, newest_mtime - started_at)
+            entry['last_used'] = time.time()
+        evict(settings, protect=used)
+
+
+def evict(settings: Dict, protect: List[str] = []):
+    """Delete the least recently used models that no running task uses until the index fits into max_entries and max_gb.
+    Call with the locked index."""
+    index = load_index()
+    entries = index['entries']
+    for eid in list(entries):
+        if not any(os.path.exists(p) for p in entries[eid].get('paths', [])):
+            entries.pop(eid)
+
+    def over_limit():
+        if settings['max_entries'] is not None and len(entries) > settings['max_entries']:
+            return True
+        total_bytes = sum(e.get('size_bytes', 0) for e in entries.values())
+        return settings['max_gb'] is not None and total_bytes > settings['max_gb'] * 1024 ** 3
+
+    candidates = sorted((eid for eid in entries if eid not in protect and eid not in index['in_use']), key=lambda eid: entries[eid]['last_used'])
+    for eid in candidates:
+        if not over_limit():
+            break
+        entry = entries.pop(eid)
+        print(f"Evicting {eid} from the model cache ({entry.get('size_bytes', 0) / 1024 ** 3:.1f} GB)")
+        for path in entry.get('paths', []):
+            shutil.rmtree(path, ignore_errors=True)
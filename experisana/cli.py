@@ -1,16 +1,26 @@
+import sys
+import importlib
 import fire
-from experisana.schedule import process_yaml as schedule_main
-from experisana.worker import main as worker_main
-from experisana.autoscale import autoscale
-from experisana.pull import pull_attachments
+
+# Modules are only imported for the command that runs: importing the worker connects to Asana,
+# which commands like `simulate` must run without
+COMMANDS = {
+    'schedule': ('experisana.schedule', 'process_yaml'),
+    'worker': ('experisana.worker', 'main'),
+    'autoscale': ('experisana.autoscale', 'autoscale'),
+    'pull': ('experisana.pull', 'pull_attachments'),
+    'daemon': ('experisana.daemon', 'daemon'),
+    'profile': ('experisana.trace', 'profile'),
+    'simulate': ('experisana.simulate', 'simulate'),
+}
 
 def main():
-    fire.Fire({
-        'schedule': schedule_main,
-        'worker': worker_main,
-        'autoscale': autoscale,
-        'pull': pull_attachments,
-    })
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command not in COMMANDS:
+        print(f"Usage: experisana <command> [arguments], where <command> is one of: {', '.join(COMMANDS)}")
+        sys.exit(1)
+    module, function = COMMANDS[command]
+    fire.Fire({command: getattr(importlib.import_module(module), function)})
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,19 @@
+import os
+import yaml
+
+
+def load_config():
+    """Check for experisana.yaml in [./, ../, ...]"""
+    cwd = os.getcwd()
+    config = {}
+    while cwd != "/":
+        config_path = os.path.join(cwd, "experisana.yaml")
+        if os.path.exists(config_path):
+            config = yaml.safe_load(open(config_path, "r"))
+        cwd = os.path.dirname(cwd)
+
+    # A bit of custom logic for imo-experiment
+    for config_path in ["/workspace/experisana.yaml", "/Users/nielswarncke/Documents/code/asana-worker/experisana.yaml"]:
+        if os.path.exists(config_path):
+            config = yaml.safe_load(open(config_path, "r"))
+    return config
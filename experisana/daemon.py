@@ -0,0 +1,355 @@
+"""Host-local board-sync daemon.
+
+Keeps a snapshot of the board in SQLite and serves all workers on this host via a
+Unix socket, so that they don't each poll Asana for runnable tasks and dependencies.
+Writes of all workers (moves, notes, comments, uploads) are queued, deduplicated and sent
+with batch requests.
+
+Start it with `experisana daemon` and point workers to it via `daemon.socket` in
+experisana.yaml or `experisana worker --daemon_socket <path>`.
+"""
+import os
+import json
+import sqlite3
+import threading
+import socketserver
+from datetime import datetime, timedelta, timezone
+from asana.rest import ApiException
+import backoff
+
+from experisana.worker import (
+    PROJECT_GID,
+    CONFIG,
+    column_gids,
+    tasks_api_instance,
+    select_runnable_task,
+    select_bundle_tasks,
+    assign_task_to_worker,
+    claim_tasks,
+    batch_request,
+    write_action,
+    upload_log_to_task,
+)
+
+DEFAULT_SOCKET = "/tmp/experisana.sock"
+DEFAULT_DB = os.path.expanduser("~/.experisana/board.sqlite")
+
+
+class BoardSnapshot:
+    """SQLite copy of the tasks on the board, synced incrementally via modified_since"""
+
+    def __init__(self, db_path):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        # Time of the latest local move or notes change per task, so that syncs started earlier don't revert it
+        self.local_changes = {}
+        with self.lock:
+            self.db.execute("CREATE TABLE IF NOT EXISTS tasks (gid TEXT PRIMARY KEY, name TEXT, notes TEXT, section_gid TEXT, modified_at TEXT, created_at TEXT)")
+            # Snapshots of older versions lack created_at, which workers need for the queue wait metric
+            if 'created_at' not in [row[1] for row in self.db.execute("PRAGMA table_info(tasks)")]:
+                self.db.execute("ALTER TABLE tasks ADD COLUMN created_at TEXT")
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self.db.commit()
+
+    def get_meta(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+            self.db.commit()
+
+    def _kept_locally(self, fetched_at, keep):
+        """Tasks whose row is newer than a fetch started at fetched_at, or has writes that weren't sent before it"""
+        self.local_changes = {task_gid: changed_at for task_gid, changed_at in self.local_changes.items() if changed_at >= fetched_at}
+        return set(keep) | set(self.local_changes)
+
+    def upsert(self, tasks, fetched_at=None, keep=()):
+        with self.lock:
+            kept = self._kept_locally(fetched_at, keep) if fetched_at else set(keep)
+            for task in tasks:
+                if task['gid'] in kept:
+                    continue
+                sections = [m['section']['gid'] for m in task.get('memberships', [])
+                            if m.get('project', {}).get('gid') == PROJECT_GID and m.get('section')]
+                self.db.execute("INSERT OR REPLACE INTO tasks (gid, name, notes, section_gid, modified_at, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                                (task['gid'], task.get('name'), task.get('notes'), sections[0] if sections else None,
+                                 task.get('modified_at'), task.get('created_at')))
+            self.db.commit()
+
+    def replace_all(self, tasks, fetched_at=None, keep=()):
+        with self.lock:
+            kept = self._kept_locally(fetched_at, keep) if fetched_at else set(keep)
+            fetched = {task['gid'] for task in tasks}
+            for (task_gid,) in self.db.execute("SELECT gid FROM tasks").fetchall():
+                if task_gid not in fetched and task_gid not in kept:
+                    self.db.execute("DELETE FROM tasks WHERE gid = ?", (task_gid,))
+        self.upsert(tasks, fetched_at, keep)
+
+    def set_notes(self, task_gid, notes):
+        with self.lock:
+            self.db.execute("UPDATE tasks SET notes = ? WHERE gid = ?", (notes, task_gid))
+            self.db.commit()
+            self.local_changes[task_gid] = datetime.now(timezone.utc)
+
+    def set_section(self, task_gid, section_gid):
+        with self.lock:
+            self.db.execute("UPDATE tasks SET section_gid = ? WHERE gid = ?", (section_gid, task_gid))
+            self.db.commit()
+            self.local_changes[task_gid] = datetime.now(timezone.utc)
+
+    def section(self, task_gid):
+        with self.lock:
+            row = self.db.execute("SELECT section_gid FROM tasks WHERE gid = ?", (task_gid,)).fetchone()
+        return row[0] if row else None
+
+    def tasks_in_section(self, section_gid):
+        with self.lock:
+            rows = self.db.execute("SELECT gid, name, notes, created_at FROM tasks WHERE section_gid = ?", (section_gid,)).fetchall()
+        return [{'gid': gid, 'name': name, 'notes': notes or '', 'created_at': created_at} for gid, name, notes, created_at in rows]
+
+
+@backoff.on_exception(backoff.expo, ApiException, max_tries=5)
+def fetch_tasks(modified_since=None):
+    params = {
+        'project': PROJECT_GID,
+        'limit': 100,
+        'opt_fields': "name,notes,created_at,modified_at,memberships.project,memberships.section",
+    }
+    if modified_since:
+        params['modified_since'] = modified_since
+    return list(tasks_api_instance.get_tasks(params))
+
+
+def sync_loop(snapshot, write_queue, interval_seconds, full_sync_minutes, stop_event):
+    """Incremental sync via modified_since, with a periodic full sync to drop deleted tasks.
+    Tasks with writes that are still queued keep their local row, as Asana doesn't have them yet."""
+    while not stop_event.is_set():
+        try:
+            now = datetime.now(timezone.utc)
+            pending = write_queue.pending_tasks()
+            last_sync = snapshot.get_meta('last_sync')
+            last_full_sync = snapshot.get_meta('last_full_sync')
+            if last_full_sync is None or now - datetime.fromisoformat(last_full_sync) > timedelta(minutes=full_sync_minutes):
+                snapshot.replace_all(fetch_tasks(), now, pending)
+                snapshot.set_meta('last_full_sync', now.isoformat())
+            else:
+                # Overlap a bit with the previous sync to not miss tasks modified while it ran
+                since = datetime.fromisoformat(last_sync) - timedelta(seconds=30)
+                snapshot.upsert(fetch_tasks(since.isoformat()), now, pending)
+            snapshot.set_meta('last_sync', now.isoformat())
+        except Exception as e:
+            print(f"Error syncing board: {e}")
+        stop_event.wait(interval_seconds)
+
+
+class WriteQueue:
+    """Collects moves, comments and uploads of all local workers and flushes them in batches.
+    Only the latest move per task is sent, and duplicate comments/uploads are dropped.
+    Writes that fail are kept for the next flush."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.moves = {}
+        self.notes = {}
+        self.comments = []
+        self.uploads = []
+        self.sending = set()
+
+    def pending_tasks(self):
+        """Tasks with moves, notes or uploads that Asana doesn't have yet, including those being sent"""
+        with self.lock:
+            return set(self.moves) | set(self.notes) | {task_gid for task_gid, path in self.uploads} | self.sending
+
+    def move(self, task_gid, section_gid):
+        with self.lock:
+            self.moves[task_gid] = section_gid
+
+    def set_notes(self, task_gid, notes):
+        with self.lock:
+            self.notes[task_gid] = notes
+
+    def comment(self, task_gid, text):
+        with self.lock:
+            if (task_gid, text) not in self.comments:
+                self.comments.append((task_gid, text))
+
+    def upload(self, task_gid, path):
+        with self.lock:
+            if (task_gid, path) not in self.uploads:
+                self.uploads.append((task_gid, path))
+
+    def flush(self):
+        with self.lock:
+            moves, self.moves = self.moves, {}
+            notes, self.notes = self.notes, {}
+            comments, self.comments = self.comments, []
+            uploads, self.uploads = self.uploads, []
+            self.sending = set(moves) | set(notes) | {task_gid for task_gid, path in uploads}
+        # Uploads first, so that results are attached before dependents see the task in Done
+        failed_uploads = []
+        for task_gid, path in uploads:
+            try:
+                upload_log_to_task(task_gid, path)
+            except Exception as e:
+                print(f"Exception when uploading {path}: {e}")
+                if os.path.exists(path):
+                    failed_uploads.append((task_gid, path))
+        # Tasks with failed uploads are only moved once everything is attached
+        waiting = {task_gid for task_gid, path in failed_uploads}
+        held_moves = {task_gid: section_gid for task_gid, section_gid in moves.items() if task_gid in waiting}
+        writes = [('notes', task_gid, task_notes) for task_gid, task_notes in notes.items()]
+        writes += [('move', task_gid, section_gid) for task_gid, section_gid in moves.items() if task_gid not in waiting]
+        writes += [('comment', task_gid, text) for task_gid, text in comments]
+        failed = []
+        for i in range(0, len(writes), 10):
+            chunk = writes[i:i + 10]
+            try:
+                results = batch_request([write_action(*write) for write in chunk])
+            except Exception as e:
+                print(f"Exception when sending queued writes, retrying with the next flush: {e}")
+                failed += writes[i:]
+                break
+            # Rate limited and server errors are retried, other errors would fail again
+            for write, result in zip(chunk, results):
+                status_code = result.get('status_code') or 500
+                if status_code == 429 or status_code >= 500:
+                    failed.append(write)
+                elif status_code >= 400:
+                    print(f"Dropping {write[0]} of task {write[1]}: {result.get('body')}")
+        self.requeue(failed_uploads, held_moves, failed)
+        return len(failed_uploads) + len(held_moves) + len(failed)
+
+    def requeue(self, uploads, moves, writes):
+        """Put failed writes back, unless a worker queued a newer move or notes for the task meanwhile"""
+        with self.lock:
+            self.uploads = [upload for upload in uploads if upload not in self.uploads] + self.uploads
+            for task_gid, section_gid in moves.items():
+                self.moves.setdefault(task_gid, section_gid)
+            comments = []
+            for kind, task_gid, value in writes:
+                if kind == 'move':
+                    self.moves.setdefault(task_gid, value)
+                elif kind == 'notes':
+                    self.notes.setdefault(task_gid, value)
+                elif (task_gid, value) not in self.comments:
+                    comments.append((task_gid, value))
+            self.comments = comments + self.comments
+            self.sending = set()
+
+    def flush_loop(self, interval_seconds, stop_event):
+        while not stop_event.wait(interval_seconds):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error flushing queued writes: {e}")
+
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        try:
+            response = {'result': getattr(self.server, f"op_{request.pop('op')}")(**request)}
+        except Exception as e:
+            response = {'error': str(e)}
+        self.wfile.write((json.dumps(response) + "\n").encode())
+
+
+class BoardSyncServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, snapshot, write_queue):
+        self.snapshot = snapshot
+        self.write_queue = write_queue
+        self.claim_lock = threading.Lock()
+        super().__init__(socket_path, DaemonHandler)
+
+    def runnable_backlog(self):
+        """Backlog tasks and a dependency check that both ignore tasks with queued writes:
+        a requeued task isn't back in the Backlog on Asana yet, and a finished one may lack its results"""
+        pending = self.write_queue.pending_tasks()
+        backlog = [task for task in self.snapshot.tasks_in_section(column_gids["Backlog"]) if task['gid'] not in pending]
+        return backlog, lambda dep: dep not in pending and self.snapshot.section(dep) == column_gids["Done"]
+
+    def op_get_task(self, exclude=(), worker_id=None):
+        backlog, is_done = self.runnable_backlog()
+        return select_runnable_task(backlog, is_done, exclude, worker_id)
+
+    def op_get_bundle(self, task_gid, group, max_tasks):
+        backlog, is_done = self.runnable_backlog()
+        return select_bundle_tasks([task for task in backlog if task['gid'] != task_gid], group, max_tasks, is_done)
+
+    def op_claim(self, task_gid, worker_id):
+        # Claims of local workers are serialized, so only claims of other hosts can conflict
+        with self.claim_lock:
+            if self.snapshot.section(task_gid) != column_gids["Backlog"] or task_gid in self.write_queue.pending_tasks():
+                return False
+            claimed = assign_task_to_worker(task_gid, worker_id)
+            self.snapshot.set_section(task_gid, column_gids["Running"] if claimed else None)
+            return claimed
+
+    def op_claim_bundle(self, tasks, worker_id):
+        with self.claim_lock:
+            pending = self.write_queue.pending_tasks()
+            tasks = [task for task in tasks if self.snapshot.section(task['gid']) == column_gids["Backlog"] and task['gid'] not in pending]
+            claimed = claim_tasks(tasks, worker_id, column_gids["Running"]) if tasks else []
+            for task in tasks:
+                self.snapshot.set_section(task['gid'], column_gids["Running"] if task['gid'] in claimed else None)
+            return claimed
+
+    def op_section(self, task_gid):
+        return self.snapshot.section(task_gid)
+
+    def op_sections(self, task_gids):
+        return {task_gid: self.snapshot.section(task_gid) for task_gid in task_gids}
+
+    def op_move(self, task_gid, section_gid):
+        self.snapshot.set_section(task_gid, section_gid)
+        self.write_queue.move(task_gid, section_gid)
+
+    def op_notes(self, task_gid, notes):
+        # Update the snapshot right away, so that local workers see e.g. the backoff of a requeued task
+        self.snapshot.set_notes(task_gid, notes)
+        self.write_queue.set_notes(task_gid, notes)
+
+    def op_comment(self, task_gid, text):
+        self.write_queue.comment(task_gid, text)
+
+    def op_upload(self, task_gid, path):
+        self.write_queue.upload(task_gid, path)
+
+
+def daemon(socket_path=None, db_path=None, sync_interval_seconds=None, flush_interval_seconds=None):
+    settings = CONFIG.get('daemon', {})
+    socket_path = socket_path or settings.get('socket', DEFAULT_SOCKET)
+    db_path = db_path or os.path.expanduser(settings.get('db', DEFAULT_DB))
+    sync_interval_seconds = sync_interval_seconds or settings.get('sync_interval_seconds', 5)
+    flush_interval_seconds = flush_interval_seconds or settings.get('flush_interval_seconds', 1)
+
+    snapshot = BoardSnapshot(db_path)
+    write_queue = WriteQueue()
+    stop_event = threading.Event()
+    threading.Thread(target=sync_loop, args=(snapshot, write_queue, sync_interval_seconds, settings.get('full_sync_minutes', 10), stop_event), daemon=True).start()
+    threading.Thread(target=write_queue.flush_loop, args=(flush_interval_seconds, stop_event), daemon=True).start()
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = BoardSyncServer(socket_path, snapshot, write_queue)
+    print(f"Serving board {PROJECT_GID} to local workers at {socket_path}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Exiting")
+    finally:
+        stop_event.set()
+        if write_queue.flush():
+            print("Some queued writes could not be sent before exiting")
+        server.server_close()
+        os.remove(socket_path)
+
+
+if __name__ == "__main__":
+    daemon()
@@ -0,0 +1,125 @@
+"""Minimal Prometheus-style metrics for the worker and the autoscaler.
+
+Metrics are always collected in memory (it's only a few dict updates); the HTTP
+endpoint that exposes them in the Prometheus text format is opt-in via
+`--metrics_port` or `metrics.port` in experisana.yaml.
+"""
+import re
+import time
+import threading
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from experisana.trace import record_span
+
+BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 1800, 3600, 7200, 21600, 86400, float("inf")]
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_gauges = {}
+_histograms = {}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, amount=1, **labels):
+    with _lock:
+        _counters[_key(name, labels)] += amount
+
+
+def set_gauge(name, value, **labels):
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name, value, **labels):
+    with _lock:
+        histogram = _histograms.setdefault(_key(name, labels), {'buckets': [0] * len(BUCKETS), 'sum': 0.0, 'count': 0})
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                histogram['buckets'][i] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+
+def _format_labels(labels, **extra):
+    labels = list(labels) + list(extra.items())
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{str(v)}"' for k, v in labels) + "}"
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    with _lock:
+        for (name, labels), value in sorted(_counters.items()):
+            lines.append(f"{name}{_format_labels(labels)} {value:g}")
+        for (name, labels), value in sorted(_gauges.items()):
+            lines.append(f"{name}{_format_labels(labels)} {value:g}")
+        for (name, labels), histogram in sorted(_histograms.items()):
+            for bound, count in zip(BUCKETS, histogram['buckets']):
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                lines.append(f"{name}_bucket{_format_labels(labels, le=le)} {count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {histogram['sum']:g}")
+            lines.append(f"{name}_count{_format_labels(labels)} {histogram['count']}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_metrics_server(port):
+    server = ThreadingHTTPServer(("", int(port)), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving metrics at http://localhost:{port}/metrics")
+    return server
+
+
+def endpoint_label(method, path):
+    """Endpoint label without gids, e.g. 'GET /tasks/{gid}'"""
+    return f"{method.upper()} {re.sub(r'/[0-9]+', '/{gid}', path)}"
+
+
+def record_api_call(endpoint, seconds, status):
+    record_span(endpoint, time.time() - seconds, seconds, kind="api", status=status)
+    inc("experisana_api_calls_total", endpoint=endpoint, status=status)
+    observe("experisana_api_call_duration_seconds", seconds, endpoint=endpoint)
+    if str(status) == "429":
+        inc("experisana_api_rate_limited_total", endpoint=endpoint)
+
+
+def instrument_api_client(api_client):
+    """Count and time every request that goes through an asana.ApiClient"""
+    call_api = api_client.call_api
+
+    def timed_call_api(resource_path, method, *args, **kwargs):
+        start = time.time()
+        status = "ok"
+        try:
+            return call_api(resource_path, method, *args, **kwargs)
+        except Exception as e:
+            status = str(getattr(e, "status", None) or type(e).__name__)
+            raise
+        finally:
+            record_api_call(endpoint_label(method, resource_path), time.time() - start, status)
+
+    api_client.call_api = timed_call_api
+    return api_client
+
+
+def count_retry(details):
+    """on_backoff handler for the backoff decorators"""
+    inc("experisana_api_retries_total", function=details['target'].__name__)
+    record_span("backoff", time.time(), details['wait'], function=details['target'].__name__)
@@ -0,0 +1,151 @@
+"""Scheduling policy shared by the workers, the autoscaler and `experisana simulate`.
+
+Everything here is a pure function of task notes, settings and the current time,
+without any calls to Asana, so that the simulator replays exactly the decisions
+that the real workers and autoscaler make.
+"""
+import re
+import json
+import random
+import itertools
+from datetime import datetime, timezone
+from typing import Dict, Optional, List
+
+
+def extract_context_from_notes(notes: str) -> Optional[Dict]:
+    """Extract the JSON context from task notes."""
+    context_match = re.search(r'# Context\n```json\n(.*?)\n```', notes, re.DOTALL)
+    if context_match:
+        try:
+            return json.loads(context_match.group(1))
+        except json.JSONDecodeError:
+            return None
+    return None
+
+def extract_priority_from_notes(notes: str) -> float:
+    """Extract the critical-path priority that `schedule` writes into the task notes."""
+    priority_match = re.search(r'^# Priority: ([0-9.]+)$', notes, re.MULTILINE)
+    if priority_match:
+        return float(priority_match.group(1))
+    return 0.0
+
+def extract_pack_from_notes(notes: str) -> Optional[Dict]:
+    """Extract the pack group of tasks that may be run together in one bundle."""
+    pack_match = re.search(r'^# Pack: (\S+) \(max (\d+), parallel (\d+)\)$', notes, re.MULTILINE)
+    if pack_match:
+        return {'group': pack_match.group(1), 'max': int(pack_match.group(2)), 'parallel': int(pack_match.group(3))}
+    return None
+
+def get_task_dependencies(task):
+    dependencies = []
+    if 'notes' in task:
+        notes_lines = task['notes'].split('\n')
+        for line in notes_lines:
+            if line.startswith('- '):
+                dependency = line.split('/')[-1].replace(')', '')
+                dependencies.append(dependency)
+    return dependencies
+
+def task_in_section(task, section_gid) -> bool:
+    """Whether the task is in section_gid on any of its boards"""
+    return any((membership.get('section') or {}).get('gid') == section_gid for membership in task.get('memberships', []))
+
+def extract_attempts_from_notes(notes: str) -> List[Dict]:
+    """Attempt history that the worker appends to the task notes when a run fails or times out."""
+    return [{'attempt': int(attempt), 'status': status, 'worker_id': worker_id, 'at': at}
+            for attempt, status, worker_id, at in re.findall(r'^# Attempt (\d+): (\S+) on (\S+) at (\S+)', notes, re.MULTILINE)]
+
+def extract_not_before_from_notes(notes: str) -> Optional[datetime]:
+    """Earliest time at which a requeued task may run again."""
+    not_before = re.findall(r'^# Not before: (\S+)$', notes, re.MULTILINE)
+    if not_before:
+        return datetime.fromisoformat(not_before[-1])
+    return None
+
+def get_avoided_workers(notes: str) -> set:
+    """Workers on which previous attempts of the task failed"""
+    return {attempt['worker_id'] for attempt in extract_attempts_from_notes(notes) if attempt['status'] == 'failed'}
+
+def is_backing_off(task, now=None) -> bool:
+    """Whether a requeued task has to wait before it may run again"""
+    not_before = extract_not_before_from_notes(task['notes'])
+    return not_before is not None and (now or datetime.now(timezone.utc)) < not_before
+
+def rank_tasks(scored_tasks: List, cache_weight: float) -> List:
+    """Order (priority, cache_score, task) tuples by priority plus weighted cache affinity.
+    The cache score is in seconds of model loading saved, weighted per minute.
+    Tasks with equal combined scores are shuffled."""
+    scored_tasks = list(scored_tasks)
+    random.shuffle(scored_tasks)
+    scored_tasks.sort(key=lambda x: x[0] + cache_weight * x[1] / 60, reverse=True)
+    return [task for priority, cache_score, task in scored_tasks]
+
+def select_runnable_task(tasks, is_done, exclude=(), worker_id=None, scheduling=None, cache_score=None, now=None):
+    """Pick the best candidate by priority and cache affinity whose dependencies are all done.
+    Tasks that failed on worker_id before are only picked if nothing else is runnable.
+    Arguments:
+        is_done: function of a task gid that tells whether the task is in Done. Tasks for which it raises are
+            skipped; this module doesn't depend on the Asana client, so any Exception is caught, not only ApiException
+        scheduling: the `scheduling` section of experisana.yaml
+        cache_score: function of a task's context that returns the seconds of model loading it saves on this host
+        now: current time (timezone-aware), for the backoff of requeued tasks
+    """
+    scheduling = scheduling or {}
+
+    # Score each task based on its priority and cache hits
+    scored_tasks = []
+    for task in itertools.islice(tasks, scheduling.get('candidates', 50)):
+        if task['gid'] in exclude or is_backing_off(task, now):
+            continue
+        context = extract_context_from_notes(task['notes'])
+        score = cache_score(context) if cache_score else 0
+        scored_tasks.append((extract_priority_from_notes(task['notes']), score, task))
+
+    # Return the best task whose dependencies are done
+    done = {}
+    ranked = rank_tasks(scored_tasks, scheduling.get('cache_weight', 0.1))
+    ranked.sort(key=lambda task: worker_id in get_avoided_workers(task['notes']))
+    for task in ranked:
+        try:
+            dependencies = get_task_dependencies(task)
+            for dep in dependencies:
+                if dep not in done:
+                    done[dep] = is_done(dep)
+            if all(done[dep] for dep in dependencies):
+                return task
+        except Exception as e:  # e.g. ApiException of the dependency lookup
+            print(f"Exception when scoring task: {e}")
+            continue
+    return None
+
+def parse_projects(projects) -> List[Dict]:
+    """[{'gid', 'weight'}] from a "gid:weight,gid:weight" string or a list of gids, "gid:weight" strings or dicts"""
+    if not isinstance(projects, (list, tuple)):
+        projects = str(projects).split(",")
+    parsed = []
+    for project in projects:
+        if isinstance(project, dict):
+            gid, weight = str(project['gid']), project.get('weight', 1)
+        else:
+            gid, _, weight = str(project).strip().partition(":")
+        if gid:
+            parsed.append({'gid': gid, 'weight': float(weight or 1)})
+    return parsed
+
+def fair_share_order(projects, running_counts) -> List[Dict]:
+    """Projects ordered by their running tasks per unit of weight, so that the pool is shared
+    according to the weights. Ties are broken randomly."""
+    projects = list(projects)
+    random.shuffle(projects)
+    return sorted(projects, key=lambda project: (running_counts.get(project['gid'], 0) + 1) / project['weight'])
+
+def should_scale_up(available_tasks: int, active_workers: int, max_workers: int) -> bool:
+    """The autoscaler starts another worker while there are more backlog tasks than workers"""
+    return active_workers < max_workers and available_tasks > active_workers
+
+def scale_wait_seconds(scale_settings: Dict) -> int:
+    """Random wait after a scale up, so that new workers can register before the next decision"""
+    return random.randint(0, scale_settings.get('wait_between_scales_min', 1) * 60)
+
+def should_shut_down(idle_seconds: float, after_idle_minutes: float) -> bool:
+    return idle_seconds > 60 * after_idle_minutes
@@ -11,6 +11,9 @@ from datetime import datetime
 import argparse
 
 from experisana.schedule import process_yaml
+from experisana.aio import AsyncAsanaClient
+from experisana.archive import MANIFEST_SUFFIX, read_manifest, all_parts, needed_parts, unpack_all
+import asyncio
 
 load_dotenv(override=True)
 
@@ -83,7 +86,99 @@ def get_contexts_from_master_task(master_task_gid):
             pass
     return tasks_cmd_and_context
 
-def pull_attachments(tag=None, url=None):
+def get_latest_attachments(attachments):
+    """Only keep the newest attachment of each name"""
+    latest_attachments = {}
+    for attachment in attachments:
+        name = attachment.get('name', 'unnamed_file')
+        created_at = attachment.get('created_at')
+        attachment_gid = attachment.get('gid')
+
+        if name not in latest_attachments or created_at > latest_attachments[name]['created_at']:
+            latest_attachments[name] = {
+                'created_at': created_at,
+                'attachment_gid': attachment_gid,
+                'download_url': attachment.get('download_url'),
+            }
+    return latest_attachments
+
+def parse_include(include):
+    """Patterns for selective extraction, as a list or comma separated string"""
+    if not include:
+        return None
+    if isinstance(include, str):
+        return [pattern.strip() for pattern in include.split(',') if pattern.strip()]
+    return list(include)
+
+def unneeded_archive_parts(folder_name, manifest_names, include):
+    """Archive parts that contain no file matching include, according to the downloaded manifests"""
+    skip = set()
+    for name in manifest_names:
+        manifest = read_manifest(os.path.join(folder_name, name))
+        if manifest is None:
+            continue
+        skip |= set(all_parts(manifest)) - set(needed_parts(manifest, include))
+    return skip
+
+def write_task_files(folder_name, task, tasks_cmd_and_context):
+    """Write the script (and context, if known) of a task to its folder"""
+    os.makedirs(folder_name, exist_ok=True)
+    with open(os.path.join(folder_name, 'cmd.sh'), 'w') as f:
+        f.write(task['notes'])
+
+    # Write cmd and context to file if available
+    if task['name'] in tasks_cmd_and_context:
+        with open(os.path.join(folder_name, 'cmd.sh'), 'w') as f:
+            f.write(tasks_cmd_and_context[task['name']]['cmd'])
+
+        with open(os.path.join(folder_name, 'context.json'), 'w') as f:
+            f.write(json.dumps(tasks_cmd_and_context[task['name']]['context'], indent=4))
+
+async def pull_tasks_async(task_gids, tasks_cmd_and_context, concurrency, include=None):
+    """Fetch tasks, list their attachments and download them with up to `concurrency` requests in flight"""
+    async with AsyncAsanaClient(max_connections=concurrency) as client:
+        tasks = await asyncio.gather(*[client.get_task(gid, "name,notes") for gid in task_gids])
+        attachment_lists = await asyncio.gather(*[client.get_attachments(task['gid']) for task in tasks])
+
+        async def download(task, name, folder_name, attachment_info):
+            download_url = attachment_info['download_url']
+            if not download_url:
+                download_url = (await client.get_attachment(attachment_info['attachment_gid'])).get('download_url')
+            if not download_url:
+                print(f"Warning: No download URL for attachment {name} in task {task['name']}. Skipping.")
+                return
+            file_path = os.path.join(folder_name, name)
+            await client.download(download_url, file_path)
+            print(f"Downloaded: {file_path}")
+
+        # Manifests of archived uploads first, to only download the archives we need
+        latest = {}
+        for task, attachments in zip(tasks, attachment_lists):
+            folder_name = sanitize_filename(task['name'])
+            write_task_files(folder_name, task, tasks_cmd_and_context)
+            latest[task['gid']] = get_latest_attachments(attachments)
+        await asyncio.gather(*[download(task, name, sanitize_filename(task['name']), info)
+                               for task in tasks for name, info in latest[task['gid']].items() if name.endswith(MANIFEST_SUFFIX)])
+
+        downloads = []
+        for task in tasks:
+            folder_name = sanitize_filename(task['name'])
+            manifests = [name for name in latest[task['gid']] if name.endswith(MANIFEST_SUFFIX)]
+            skip = set(manifests) | unneeded_archive_parts(folder_name, manifests, include)
+            for name, attachment_info in latest[task['gid']].items():
+                if name not in skip:
+                    downloads.append((task, name, folder_name, attachment_info))
+        await asyncio.gather(*[download(*args) for args in downloads])
+
+        for task in tasks:
+            unpack_all(sanitize_filename(task['name']), include)
+
+def pull_attachments(tag=None, url=None, concurrency=0, include=None):
+    """Download the attachments of all tasks with a tag or linked from a master task.
+    With concurrency > 0, downloads run via the async client with that many requests in flight.
+    Archived uploads are unpacked into the task folders; with include (glob patterns, e.g. 'eval/*'),
+    only the matching files are extracted and only the archives that contain them are downloaded."""
+    include = parse_include(include)
     if tag:
         tasks = get_tasks_by_tag(tag)
         tasks_cmd_and_context = {}
@@ -96,7 +191,11 @@ def pull_attachments(tag=None, url=None):
         tasks_cmd_and_context = get_contexts_from_master_task(master_task_gid)
         # Extract subtask GIDs from master task notes
         subtask_gids = re.findall(r'https://app\.asana\.com/0/\d+/(\d+)', master_task['notes'])
-        tasks = [get_task_details(gid) for gid in subtask_gids]
+        if concurrency:
+            # Details are fetched concurrently later
+            tasks = [{'gid': gid} for gid in subtask_gids]
+        else:
+            tasks = [get_task_details(gid) for gid in subtask_gids]
     else:
         # This should never happen due to the argument parser, but just in case:
         raise ValueError("Either tag or master_task_url must be provided.")
@@ -105,31 +204,23 @@ def pull_attachments(tag=None, url=None):
         print("No tasks found.")
         return
 
+    if concurrency:
+        asyncio.run(pull_tasks_async([task['gid'] for task in tasks], tasks_cmd_and_context, concurrency, include))
+        print("All attachments have been downloaded.")
+        return
 
     for task in tasks:
         folder_name = sanitize_filename(task['name'])
-        os.makedirs(folder_name, exist_ok=True)
-
-        # Write task description to cmd.sh
-        with open(os.path.join(folder_name, 'cmd.sh'), 'w') as f:
-            f.write(task['notes'])
-
-        attachments = get_attachments(task['gid'])
-        latest_attachments = {}
-
-        for attachment in attachments:
-            name = attachment.get('name', 'unnamed_file')
-            created_at = attachment.get('created_at')
-            attachment_gid = attachment.get('gid')
-
-            if name not in latest_attachments or created_at > latest_attachments[name]['created_at']:
-                latest_attachments[name] = {
-                    'created_at': created_at,
-                    'attachment_gid': attachment_gid
-                }
-
-        for name, attachment_info in latest_attachments.items():
-            attachment_details = get_attachment_details(attachment_info['attachment_gid'])
+        write_task_files(folder_name, task, tasks_cmd_and_context)
+
+        attachments = get_latest_attachments(get_attachments(task['gid']))
+        # Manifests of archived uploads first, to only download the archives we need
+        manifests = [name for name in attachments if name.endswith(MANIFEST_SUFFIX)]
+        skip = set()
+        for name in manifests + [name for name in attachments if name not in manifests]:
+            if name in skip:
+                continue
+            attachment_details = get_attachment_details(attachments[name]['attachment_gid'])
             download_url = attachment_details.get('download_url')
 
             if not download_url:
@@ -139,14 +230,9 @@ def pull_attachments(tag=None, url=None):
             file_path = os.path.join(folder_name, name)
             download_file(download_url, file_path)
             print(f"Downloaded: {file_path}")
-
-        # Write cmd and context to file if available
-        if task['name'] in tasks_cmd_and_context:
-            with open(os.path.join(folder_name, 'cmd.sh'), 'w') as f:
-                f.write(tasks_cmd_and_context[task['name']]['cmd'])
-
-            with open(os.path.join(folder_name, 'context.json'), 'w') as f:
-                f.write(json.dumps(tasks_cmd_and_context[task['name']]['context'], indent=4))
+            if name in manifests:
+                skip |= unneeded_archive_parts(folder_name, [name], include)
+        unpack_all(folder_name, include)
 
     print("All attachments have been downloaded.")
 
@@ -0,0 +1,192 @@
+"""Resource usage sampling for the process tree of a running job.
+
+Reads /proc, the cgroup of the worker and optionally nvidia-smi every few seconds,
+so that the worker can post peaks/averages and a CSV of all samples when the task
+finishes. This shows which jobs leave an expensive GPU idle, e.g. while waiting on
+data loading.
+"""
+import os
+import csv
+import time
+import shutil
+import threading
+import subprocess
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+SPARK_CHARS = "▁▂▃▄▅▆▇█"
+FIELDS = ["time", "n_procs", "cpu_percent", "rss_mb", "read_mb", "write_mb", "cgroup_mem_mb", "gpu_util", "gpu_mem_mb"]
+
+
+def get_process_tree(root_pid):
+    """root_pid and all of its descendants"""
+    children = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat", "r") as f:
+                # The command name may contain spaces, so split after its closing parenthesis
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(name))
+    tree, stack = [], [root_pid]
+    while stack:
+        pid = stack.pop()
+        tree.append(pid)
+        stack += children.get(pid, [])
+    return tree
+
+
+def read_process(pid):
+    """(cpu ticks, rss bytes, read bytes, written bytes) of a process, or None if it exited"""
+    try:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        ticks = int(fields[11]) + int(fields[12])
+        rss = int(fields[21]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, IndexError, ValueError):
+        return None
+    read_bytes = write_bytes = 0
+    try:
+        with open(f"/proc/{pid}/io", "r") as f:
+            for line in f:
+                key, value = line.split(":")
+                if key == "read_bytes":
+                    read_bytes = int(value)
+                elif key == "write_bytes":
+                    write_bytes = int(value)
+    except (OSError, ValueError):
+        pass
+    return ticks, rss, read_bytes, write_bytes
+
+
+def read_cgroup_memory():
+    for path in ["/sys/fs/cgroup/memory.current", "/sys/fs/cgroup/memory/memory.usage_in_bytes"]:
+        try:
+            with open(path, "r") as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            continue
+    return None
+
+
+def read_gpus(pids):
+    """(mean utilization of the GPUs used by pids, GPU memory used by pids in MB)"""
+    try:
+        apps = subprocess.run(["nvidia-smi", "--query-compute-apps=pid,gpu_uuid,used_memory", "--format=csv,noheader,nounits"],
+                              capture_output=True, text=True, timeout=10, check=True).stdout
+        gpus = subprocess.run(["nvidia-smi", "--query-gpu=uuid,utilization.gpu", "--format=csv,noheader,nounits"],
+                              capture_output=True, text=True, timeout=10, check=True).stdout
+    except (OSError, subprocess.SubprocessError):
+        return None, None
+    utilization = {}
+    for line in gpus.strip().splitlines():
+        uuid, util = [x.strip() for x in line.split(",")]
+        utilization[uuid] = float(util)
+    used_gpus, memory = set(), 0.0
+    for line in apps.strip().splitlines():
+        pid, uuid, used_memory = [x.strip() for x in line.split(",")]
+        if pid.isdigit() and int(pid) in pids:
+            used_gpus.add(uuid)
+            memory += float(used_memory)
+    if not used_gpus:
+        return 0.0, 0.0
+    return sum(utilization.get(uuid, 0.0) for uuid in used_gpus) / len(used_gpus), memory
+
+
+def sparkline(values):
+    values = [v for v in values if v is not None]
+    if not values:
+        return ""
+    top = max(values) or 1
+    return "".join(SPARK_CHARS[min(len(SPARK_CHARS) - 1, int(v / top * (len(SPARK_CHARS) - 1)))] for v in values)
+
+
+class ResourceSampler:
+    """Samples the process tree of `pid` in a background thread until stop() is called"""
+
+    def __init__(self, pid, interval_seconds=5, gpu=True):
+        self.pid = pid
+        self.interval_seconds = interval_seconds
+        self.gpu = gpu and shutil.which("nvidia-smi") is not None
+        self.samples = []
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        # Per pid counters of the previous sample, so that exited processes don't make the totals go down
+        self._last = {}
+        self._io = [0, 0]
+        self._start = time.time()
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+        return self
+
+    def _run(self):
+        last_time = time.time()
+        while not self._stop_event.wait(self.interval_seconds):
+            now = time.time()
+            try:
+                self.samples.append(self._sample(now - last_time, now))
+            except Exception as e:
+                print(f"Error sampling resources: {e}")
+            last_time = now
+
+    def _sample(self, elapsed, now):
+        pids = get_process_tree(self.pid)
+        ticks = rss = 0
+        current = {}
+        for pid in pids:
+            stats = read_process(pid)
+            if stats is None:
+                continue
+            current[pid] = stats
+            last = self._last.get(pid, (0, 0, 0, 0))
+            ticks += stats[0] - last[0]
+            rss += stats[1]
+            self._io[0] += stats[2] - last[2]
+            self._io[1] += stats[3] - last[3]
+        self._last = current
+        cgroup_memory = read_cgroup_memory()
+        gpu_util, gpu_memory = read_gpus(set(current)) if self.gpu else (None, None)
+        return {
+            "time": round(now - self._start, 1),
+            "n_procs": len(current),
+            "cpu_percent": round(100 * ticks / CLOCK_TICKS / elapsed, 1),
+            "rss_mb": round(rss / 1024 ** 2, 1),
+            "read_mb": round(self._io[0] / 1024 ** 2, 1),
+            "write_mb": round(self._io[1] / 1024 ** 2, 1),
+            "cgroup_mem_mb": cgroup_memory and round(cgroup_memory / 1024 ** 2, 1),
+            "gpu_util": gpu_util,
+            "gpu_mem_mb": gpu_memory,
+        }
+
+    def write_csv(self, file_path):
+        with open(file_path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(self.samples)
+        return file_path
+
+    def summary(self):
+        """Compact text with peaks, averages and sparklines of the samples"""
+        if not self.samples:
+            return "Resources: no samples (task finished before the first sample)"
+        lines = [f"Resources ({len(self.samples)} samples every {self.interval_seconds}s):"]
+        for field, unit in [("cpu_percent", "%"), ("rss_mb", " MB"), ("cgroup_mem_mb", " MB"), ("gpu_util", "%"), ("gpu_mem_mb", " MB")]:
+            values = [s[field] for s in self.samples if s[field] is not None]
+            if not values:
+                continue
+            lines.append(f"  {field}: avg {sum(values) / len(values):.1f}{unit}, peak {max(values):.1f}{unit} {sparkline(values[-60:])}")
+        gpu_samples = [s for s in self.samples if s["gpu_mem_mb"]]
+        if gpu_samples:
+            idle = sum(s["gpu_util"] < 10 for s in gpu_samples) / len(gpu_samples)
+            lines.append(f"  GPU idle (<10% utilization) in {idle:.0%} of the samples while holding GPU memory")
+        last = self.samples[-1]
+        lines.append(f"  disk io: read {last['read_mb']:.1f} MB, written {last['write_mb']:.1f} MB")
+        return "\n".join(lines)
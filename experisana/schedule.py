@@ -1,6 +1,4 @@
-import json
 import yaml
-import re
 from typing import List, Dict
 import asana
 from asana.rest import ApiException
@@ -13,65 +11,14 @@ from experisana.worker import (
     tasks_api_instance,
     upload_log_to_task
 )
+from experisana.aio import AsyncAsanaClient
+from experisana.sweep import simulate_makespan, expand_sweep, format_notes
+import asyncio
 import random
 import fire
-import itertools
 import os
 
 
-
-def load_yaml(file_path: str) -> Dict:
-    with open(file_path, 'r') as file:
-        config = yaml.safe_load(file)
-        if 'sweep' not in config and 'default' in config:
-            config['sweep'] = config.pop('default')
-        if 'stages' not in config:
-            default_stage_name = file_path.split('/')[-1].split('.')[0]
-            config['stages'] = [{'name': default_stage_name}]
-        return config
-
-def substitute_variables(value: str, context: dict[str, str]) -> str:
-    """
-    Fills the value with data from the context.
-    Example:
-        value = "{some_nested_{var}}"
-        context = {'var': 1, 'some_nested_1': 'yey', 'some_nested_2': 'oops'}
-        # Returns: 'yey'
-    Arguments:
-        value: string to be filled with values from the context
-        context: dict
-    Returns:
-        str: value filled with data from the context
-        accessed_variables: a dict of {variable: value} that were accessed
-    """
-    prev = ''
-    accessed_variables = {}
-    while value != prev:
-        prev = value
-        for key, val in context.items():
-            if isinstance(val, dict):
-                # Handle nested dictionaries
-                for nested_key, nested_val in val.items():
-                    replace_key = f"{key}.{nested_key}"
-                    if replace_key in value:
-                        value = value.replace(f"{{{key}.{nested_key}}}", str(nested_val))
-                        accessed_variables[replace_key] = nested_val
-            elif f"{{{key}}}" in value:
-                accessed_variables[key] = val
-                value = value.replace(f"{{{key}}}", str(val))
-    return value, accessed_variables
-
-def dict_to_hash(d):
-    """Takes a dictionary and returns a deterministic hash"""
-    keys = sorted(d.keys(), key=str)
-    return hash(frozenset((key, d[key]) for key in keys))
-
-
-
-def resolve_dependencies(value: str, jobs_context: Dict[str, Dict[str, str]]) -> str:
-    pattern = re.compile(r'\$\((\w+)\.(\w+)\)')
-    return pattern.sub(lambda match: jobs_context[match.group(1)][match.group(2)], value)
-
 tags_api_instance = asana.TagsApi(api_client)
 job_name_to_gid = {}
 
@@ -98,17 +45,9 @@ def get_or_create_tag(tag_name: str) -> str:
     tag = tags_api_instance.create_tag(tag_data, {'opt_fields': 'gid'})
     return tag['gid']
 
-def schedule(task_name: str, script: str, depends_on: List[str], tags: List[str] = [], title: str = None, context: Dict = None):
-    notes = f"# Script\n{script}\n\n# Depends on\n"
-    for dependency in depends_on:
-        dependency_gid = job_name_to_gid.get(dependency, None)
-        if dependency_gid:
-            notes += f"- {dependency} (https://app.asana.com/0/{WORKSPACE_GID}/{dependency_gid})\n"
-        else:
-            notes += f"- {dependency} (GID not found)\n"
-
-    if context:
-        notes += f"\n# Context\n```json\n{json.dumps(context, indent=2)}\n```"
+def schedule(task_name: str, script: str, depends_on: List[str], tags: List[str] = [], title: str = None, context: Dict = None, priority: float = None, pack: Dict = None, timeout_min: float = None):
+    dependency_gids = [(dependency, job_name_to_gid.get(dependency, None)) for dependency in depends_on]
+    notes = format_notes(script, dependency_gids, context=context, priority=priority, pack=pack, timeout_min=timeout_min, workspace_gid=WORKSPACE_GID)
     task_data = {
         "data": {
             "name": title or task_name,
@@ -132,19 +71,42 @@ def schedule(task_name: str, script: str, depends_on: List[str], tags: List[str]
     job_name_to_gid[task_name] = int(task_gid)
     return task_gid
 
-def generate_combinations(parameters: Dict[str, List[str]]) -> List[Dict[str, str]]:
-    keys, values = zip(*parameters.items())
-    return [dict(zip(keys, combination)) for combination in itertools.product(*values)]
-
-def flatten_dict(d: Dict, parent_key: str = '', sep: str = '.') -> Dict:
-    items = []
-    for k, v in d.items():
-        new_key = f"{parent_key}{sep}{k}" if parent_key else k
-        if isinstance(v, dict):
-            items.extend(flatten_dict(v, new_key, sep=sep).items())
-        else:
-            items.append((new_key, v))
-    return dict(items)
+async def schedule_async(jobs: List[Dict], concurrency: int = 20) -> Dict[str, str]:
+    """
+    Create the tasks of a sweep concurrently. Stages are created one after another, so that the
+    dependency links of a stage can point to the tasks of the stages before it.
+    Arguments:
+        jobs: [{'id', 'job_name', 'script', 'depends_on': [(job name, job id)], 'tags', 'title', 'context', 'priority', 'pack', 'timeout_min', 'level'}]
+    Returns:
+        {title: task gid}
+    """
+    # Dependencies are linked by job id, since titles repeat across combinations without a per-stage model_id
+    id_to_gid, title_to_gid = {}, {}
+    async with AsyncAsanaClient(max_connections=concurrency) as client:
+        tag_gids = {tag['name']: tag['gid'] for tag in await client.get_tags_for_workspace(WORKSPACE_GID)}
+        async def create_tag(tag_name):
+            tag = await client.create_tag({"name": tag_name, "workspace": WORKSPACE_GID, "color": random_color()})
+            tag_gids[tag_name] = tag['gid']
+        missing_tags = {tag for job in jobs for tag in job['tags'] if tag and tag not in tag_gids}
+        await asyncio.gather(*[create_tag(tag_name) for tag_name in missing_tags])
+
+        async def create(job):
+            dependency_gids = [(dependency, id_to_gid.get(job_id)) for dependency, job_id in job['depends_on']]
+            notes = format_notes(job['script'], dependency_gids, context=job['context'], priority=job['priority'], pack=job['pack'], timeout_min=job['timeout_min'], workspace_gid=WORKSPACE_GID)
+            task = await client.create_task({
+                "name": job['title'],
+                "notes": notes,
+                "projects": [PROJECT_GID],
+                "memberships": [{"project": PROJECT_GID, "section": BACKLOG_COLUMN_GID}]
+            })
+            await asyncio.gather(*[client.add_tag(task['gid'], tag_gids[tag_name]) for tag_name in job['tags'] if tag_name])
+            print(f"Task '{job['job_name']}' created with GID: {task['gid']}")
+            id_to_gid[job['id']] = task['gid']
+            title_to_gid[job['title']] = task['gid']
+
+        for level in sorted({job['level'] for job in jobs}):
+            await asyncio.gather(*[create(job) for job in jobs if job['level'] == level])
+    return title_to_gid
 
 
 def str_presenter(dumper, data):
@@ -181,63 +143,46 @@ def create_master_task(file_path: str, scheduled_tasks: Dict[str, str]):
     upload_log_to_task(master_task_gid, file_path)
     print(f"Master task '{file_name}' created with GID: {master_task_gid}")
 
-def process_yaml(file_path: str, onlyprint: bool = False, silent: bool = False) -> Dict[str, Dict[str, str]]:
+def process_yaml(file_path: str, onlyprint: bool = False, silent: bool = False, workers: int = 1, concurrency: int = 0) -> Dict[str, Dict[str, str]]:
+    """Expand the sweep in file_path and create one task per job. With concurrency > 0, tasks are created via the async client with that many requests in flight."""
     if silent:
         maybe_print = lambda *args, **kwargs: None
     else:
         maybe_print = print
     tasks_cmd_and_context = {}
-    config = load_yaml(file_path)
-    
-    script_template = config['script']
-    sweep_context = config['sweep']
-    stages = config['stages']
-    
-    # Handle nested parameters
-    flat_sweep_context = flatten_dict(sweep_context)
-    list_parameters = {k: v for k, v in flat_sweep_context.items() if isinstance(v, list)}
-    if list_parameters:
-        combinations = generate_combinations(list_parameters)
-    else:
-        combinations = [{}]
-
-    jobs_context = {}
-    jobs_dependencies = {}
     scheduled_tasks = {}
-
-    unique_keys = set()
-
-    for combination in combinations:
-        combined_context = {**flat_sweep_context, **combination}
-        for stage in stages:
-            context = {**combined_context, **stage}
-            
-            for nested_level in range(4):
-                for key, value in context.items():
-                    if isinstance(value, str):
-                        context[key], _ = substitute_variables(value, context)
-                        context[key] = resolve_dependencies(context[key], jobs_context)
-            
-            job_name = context['name']
-            jobs_context[job_name] = context
-            jobs_dependencies[job_name] = [match.group(1) for match in re.finditer(r'\$\(([a-zA-Z0-9_-]+)\.\w+\)', str(stage))]
-
-            script, accessed_variables = substitute_variables(script_template, context)
-            if dict_to_hash(accessed_variables) in unique_keys:
-                continue
-            unique_keys.add(dict_to_hash(accessed_variables))
-            maybe_print("-" * 80)
-            maybe_print('# ' + yaml.dump({
-                'Job': job_name,
-                'context': accessed_variables
-            }, default_flow_style=False, sort_keys=False, indent=2, width=120).replace('\n', '\n# '))
-            title = context.get('model_id') or job_name
-            tasks_cmd_and_context[title] = {'cmd': script, 'context': accessed_variables}
-            maybe_print(script)
-            tags = [i.strip() for i in context.get('tags', '').split(',')]
-            if not onlyprint:
-                task_guid = schedule(job_name, script, jobs_dependencies[job_name], tags=tags, title=title, context=accessed_variables)
-                scheduled_tasks[title] = task_guid
+    simulated_jobs = {}
+    pending_jobs = []
+
+    jobs, priorities = expand_sweep(file_path)
+    for job in jobs:
+        job_name, title, script = job['job_name'], job['title'], job['script']
+        maybe_print("-" * 80)
+        maybe_print('# ' + yaml.dump({
+            'Job': job_name,
+            'context': job['context']
+        }, default_flow_style=False, sort_keys=False, indent=2, width=120).replace('\n', '\n# '))
+        tasks_cmd_and_context[title] = {'cmd': script, 'context': job['context']}
+        # Keyed by job id, since titles repeat across combinations without a per-stage model_id
+        simulated_jobs[job['id']] = {
+            'duration': job['weight'],
+            'depends_on': [dep_id for dep, dep_id in job['depends_on'] if dep_id is not None],
+            'priority': job['priority'],
+        }
+        maybe_print(script)
+        if not onlyprint and concurrency:
+            pending_jobs.append(job)
+        elif not onlyprint:
+            task_guid = schedule(job_name, script, job['dependencies'], tags=job['tags'], title=title, context=job['context'], priority=job['priority'], pack=job['pack'], timeout_min=job['timeout_min'])
+            scheduled_tasks[title] = task_guid
+
+    maybe_print("-" * 80)
+    maybe_print(f"# Stage priorities: {priorities}")
+    maybe_print(f"# Expected makespan with {workers} worker(s), in units of priority_weight: "
+                f"{simulate_makespan(simulated_jobs, workers):g} (random order: {simulate_makespan(simulated_jobs, workers, 'random'):g})")
+
+    if pending_jobs:
+        scheduled_tasks = asyncio.run(schedule_async(pending_jobs, concurrency))
 
     if not onlyprint:
         create_master_task(file_path, scheduled_tasks)
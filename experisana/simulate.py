@@ -0,0 +1,384 @@
+"""Discrete-event simulation of workers and the autoscaler working through a sweep.
+
+The sweep is expanded like `experisana schedule` does it, and simulated workers pick
+tasks with the same selection logic (`policy.select_runnable_task`: priorities,
+cache affinity, candidates) as the real ones. The autoscaler starts and the workers
+stop based on the same `scale` and `shutdown` settings (`policy.should_scale_up`,
+`policy.should_shut_down`). This makes it possible to compare settings offline:
+
+    experisana simulate stages.yaml --durations durations.yaml --scale_max 4
+
+Task durations are given per stage or title in minutes, either fixed or as a
+distribution, and/or taken from the trace.jsonl files that `pull` downloads into
+the task folders (with `trace.attach` enabled):
+
+    stage1: 120
+    stage1-intervention: {dist: lognormal, mean: 90, std: 30}
+    "*": {dist: uniform, min: 30, max: 60}
+
+Not modelled: packing, failures and retries, several boards, and the board-sync daemon.
+API calls are counted from the requests the worker and autoscaler make per step.
+"""
+import os
+import re
+import json
+import math
+import heapq
+import random
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List
+
+import fire
+import yaml
+
+from experisana.config import load_config
+from experisana.cache import get_cache_settings
+from experisana.sweep import expand_sweep, format_notes
+from experisana.policy import (
+    select_runnable_task,
+    should_scale_up,
+    scale_wait_seconds,
+    should_shut_down,
+)
+
+# The main loops of the worker and the autoscaler sleep this long when there is nothing to do
+POLL_SECONDS = 5
+SIM_EPOCH = datetime(2024, 1, 1, tzinfo=timezone.utc)
+# Phases of a task other than its execution, as recorded in traces
+OVERHEAD_PHASES = ["claim", "download", "setup", "move", "log_post", "uploads"]
+
+
+def sample_duration(spec, rng=random) -> float:
+    """Minutes from a duration spec: a number, a list of observed durations or a distribution"""
+    if isinstance(spec, (int, float)):
+        return float(spec)
+    if isinstance(spec, list):
+        return float(rng.choice(spec))
+    dist = spec.get('dist', 'fixed')
+    if dist == 'fixed':
+        return float(spec['mean'])
+    if dist == 'uniform':
+        return rng.uniform(spec['min'], spec['max'])
+    if dist == 'normal':
+        return max(0.0, rng.gauss(spec['mean'], spec['std']))
+    if dist == 'lognormal':
+        # Parametrized by the mean and standard deviation of the duration itself
+        sigma2 = math.log(1 + (spec['std'] / spec['mean']) ** 2)
+        return rng.lognormvariate(math.log(spec['mean']) - sigma2 / 2, math.sqrt(sigma2))
+    if dist == 'exponential':
+        return rng.expovariate(1 / spec['mean'])
+    raise ValueError(f"Unknown duration distribution: {dist}")
+
+
+def sanitize_filename(filename):
+    """Folder name that `pull` uses for a task title"""
+    return re.sub(r'[^\w\-_\. ]', '_', filename.split('/')[-1])
+
+
+def durations_from_traces(paths, jobs) -> (Dict[str, List[float]], List[float]):
+    """
+    Execute durations in minutes per stage, and the seconds per task spent in the other phases.
+    Traces in pulled task folders are attributed to the stage of that task, all others to '*'.
+    """
+    folder_to_stage = {sanitize_filename(job['title']): job['job_name'] for job in jobs}
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += [os.path.join(root, file) for root, dirs, names in os.walk(path) for file in names if file.endswith(".jsonl")]
+        else:
+            files.append(path)
+
+    executions = defaultdict(list)
+    overheads = defaultdict(float)
+    for file in files:
+        stage = folder_to_stage.get(os.path.basename(os.path.dirname(os.path.abspath(file))), '*')
+        with open(file, "r") as f:
+            for line in f:
+                try:
+                    span = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if span.get('kind') != 'phase' or not span.get('task_gid'):
+                    continue
+                if span['name'] == 'execute' and span.get('status', 'ok') == 'succeeded':
+                    executions[stage].append(span['duration'] / 60)
+                elif span['name'] in OVERHEAD_PHASES:
+                    overheads[(file, span['task_gid'])] += span['duration']
+    return dict(executions), list(overheads.values())
+
+
+class Simulation:
+    def __init__(self, jobs, config, durations=None, trace_durations=None, overheads=None, workers=0,
+                 autoscale=True, boot_min=3, model_load_min=10, default_min=60, max_hours=24 * 30):
+        self.config = config
+        self.durations = durations or {}
+        self.trace_durations = trace_durations or {}
+        self.overheads = overheads or []
+        self.boot_seconds = 60 * boot_min
+        self.model_load_seconds = 60 * model_load_min
+        self.default_min = default_min
+        self.max_seconds = 3600 * max_hours
+        self.cache_keys = get_cache_settings(config)['keys']
+        self.status_check_seconds = config.get('preemption', {}).get('status_check_seconds', 15)
+        self.scale = config.get('scale') if autoscale else None
+        self.after_idle_minutes = config.get('shutdown', {}).get('after_idle_minutes')
+
+        # The board: tasks in creation order, with notes in the format of `schedule`
+        # Titles repeat across combinations without a per-stage model_id, so gids are derived from the job ids
+        self.tasks = []
+        for job in jobs:
+            dependency_gids = [(dependency, None if job_id is None else str(job_id + 1)) for dependency, job_id in job['depends_on']]
+            notes = format_notes(job['script'], dependency_gids, context=job['context'], priority=job['priority'],
+                                 pack=job['pack'], timeout_min=job['timeout_min'], workspace_gid="0")
+            self.tasks.append({'gid': str(job['id'] + 1), 'name': job['title'], 'notes': notes, 'job': job})
+        self.section = {task['gid']: 'Backlog' for task in self.tasks}
+
+        self.now = 0.0
+        self.events = []
+        self.seq = 0
+        self.workers = []
+        self.api_calls = defaultdict(int)
+        self.finished_at = {}
+        self.autoscaler = {'token': 0, 'idle_from': None}
+        for _ in range(workers):
+            self.start_worker(boot_seconds=0)
+        if self.scale:
+            self.push(0.0, 'autoscale', None, 0)
+
+    # Event queue
+    def push(self, time, kind, worker, token):
+        self.seq += 1
+        heapq.heappush(self.events, (time, self.seq, kind, worker, token))
+
+    def backlog(self):
+        return [task for task in self.tasks if self.section[task['gid']] == 'Backlog']
+
+    def backlog_pages(self):
+        return max(1, math.ceil(len(self.backlog()) / 100))
+
+    def next_tick(self, idle_from):
+        """First poll of a sleeping loop after now"""
+        return idle_from + POLL_SECONDS * max(1, math.ceil((self.now - idle_from) / POLL_SECONDS))
+
+    # Workers
+    def start_worker(self, boot_seconds):
+        worker = {'id': f"sim-worker-{len(self.workers) + 1}", 'started_at': self.now, 'stopped_at': None,
+                  'busy_seconds': 0.0, 'cache': set(), 'token': 0, 'idle_from': None, 'idle_since': None,
+                  'idle_poll_calls': 0, 'registered': False, 'tasks': 0}
+        self.workers.append(worker)
+        self.push(self.now + boot_seconds, 'register', worker, 0)
+
+    def active_workers(self):
+        return sum(worker['registered'] and worker['stopped_at'] is None for worker in self.workers)
+
+    def cache_score(self, worker, context):
+        if not context:
+            return 0
+        return sum(self.model_load_seconds for key in self.cache_keys if key in context and (key, str(context[key])) in worker['cache'])
+
+    def task_duration(self, task, worker):
+        """Seconds from claim to the final move: overhead, loading of uncached models and execution"""
+        job = task['job']
+        for key in [job['job_name'], job['title']]:
+            if key in self.durations:
+                minutes = sample_duration(self.durations[key])
+                break
+        else:
+            if self.trace_durations.get(job['job_name']):
+                minutes = sample_duration(self.trace_durations[job['job_name']])
+            elif '*' in self.durations:
+                minutes = sample_duration(self.durations['*'])
+            elif self.trace_durations.get('*'):
+                minutes = sample_duration(self.trace_durations['*'])
+            else:
+                minutes = job['weight'] * self.default_min
+        context = job['context'] or {}
+        misses = [(key, str(context[key])) for key in self.cache_keys if key in context and (key, str(context[key])) not in worker['cache']]
+        worker['cache'].update(misses)
+        overhead = random.choice(self.overheads) if self.overheads else 0
+        return 60 * minutes + self.model_load_seconds * len(misses) + overhead
+
+    def poll(self, worker):
+        """One iteration of the worker's main loop"""
+        calls = self.backlog_pages()
+
+        def is_done(gid):
+            nonlocal calls
+            calls += 1
+            return self.section.get(gid) == 'Done'
+
+        task = select_runnable_task(self.backlog(), is_done, worker_id=worker['id'],
+                                    scheduling=self.config.get('scheduling', {}),
+                                    cache_score=lambda context: self.cache_score(worker, context),
+                                    now=SIM_EPOCH + timedelta(seconds=self.now))
+        self.api_calls['selection'] += calls
+        if task is None:
+            if self.after_idle_minutes is not None and should_shut_down(self.now - worker['idle_since'], self.after_idle_minutes):
+                worker['stopped_at'] = self.now
+                self.api_calls['registration'] += 1
+                self.wake_autoscaler()
+                return
+            # Sleep until the board changes or the worker would shut down
+            worker['idle_from'] = self.now
+            worker['idle_poll_calls'] = calls
+            if self.after_idle_minutes is not None:
+                shutdown_at = worker['idle_since'] + 60 * self.after_idle_minutes
+                ticks = max(1, math.floor((shutdown_at - self.now) / POLL_SECONDS) + 1)
+                self.push(self.now + POLL_SECONDS * ticks, 'poll', worker, worker['token'])
+            return
+
+        self.api_calls['selection'] += 1  # get_task_details of the selected task
+        self.api_calls['claim'] += 4
+        self.section[task['gid']] = 'Running'
+        duration = self.task_duration(task, worker)
+        worker['busy_seconds'] += duration
+        worker['idle_from'] = None
+        worker['tasks'] += 1
+        worker['token'] += 1
+        # Move to Running, list attachments, status checks, move to Done and the log comment
+        self.api_calls['execution'] += 2 + int(duration // self.status_check_seconds)
+        self.api_calls['results'] += 2
+        self.push(self.now + duration, 'finish', worker, task['gid'])
+        self.wake_autoscaler()
+
+    def wake_idle(self):
+        """The board changed, so sleeping workers find out in their next poll"""
+        for worker in self.workers:
+            if worker['idle_from'] is not None and worker['stopped_at'] is None:
+                tick = self.next_tick(worker['idle_from'])
+                skipped = int(round((tick - worker['idle_from']) / POLL_SECONDS)) - 1
+                self.api_calls['selection'] += skipped * worker['idle_poll_calls']
+                worker['idle_from'] = None
+                worker['token'] += 1
+                self.push(tick, 'poll', worker, worker['token'])
+
+    # Autoscaler
+    def autoscale(self):
+        self.api_calls['autoscaler'] += self.backlog_pages() + 1
+        if should_scale_up(len(self.backlog()), self.active_workers(), self.scale['max']):
+            self.api_calls['autoscaler'] += 3
+            self.start_worker(self.boot_seconds)
+            self.autoscaler['idle_from'] = None
+            self.push(self.now + scale_wait_seconds(self.scale), 'autoscale', None, self.autoscaler['token'])
+        else:
+            self.autoscaler['idle_from'] = self.now
+
+    def wake_autoscaler(self):
+        if not self.scale or self.autoscaler['idle_from'] is None:
+            return
+        tick = self.next_tick(self.autoscaler['idle_from'])
+        skipped = int(round((tick - self.autoscaler['idle_from']) / POLL_SECONDS)) - 1
+        self.api_calls['autoscaler'] += skipped * (self.backlog_pages() + 1)
+        self.autoscaler['idle_from'] = None
+        self.autoscaler['token'] += 1
+        self.push(tick, 'autoscale', None, self.autoscaler['token'])
+
+    def run(self) -> Dict:
+        while self.events:
+            time, _, kind, worker, token = heapq.heappop(self.events)
+            if time > self.max_seconds:
+                print(f"Stopping the simulation after {self.max_seconds / 3600:g} hours")
+                break
+            self.now = time
+            if kind == 'autoscale':
+                if token == self.autoscaler['token']:
+                    self.autoscale()
+            elif kind == 'register':
+                worker['registered'] = True
+                worker['idle_since'] = self.now
+                self.api_calls['registration'] += 2
+                self.wake_autoscaler()
+                self.poll(worker)
+            elif kind == 'poll':
+                if token == worker['token'] and worker['stopped_at'] is None:
+                    self.poll(worker)
+            elif kind == 'finish':
+                self.section[token] = 'Done'
+                self.finished_at[token] = self.now
+                worker['idle_since'] = self.now
+                worker['token'] += 1
+                self.wake_idle()
+                self.wake_autoscaler()
+                self.poll(worker)
+            if len(self.finished_at) == len(self.tasks) and self.after_idle_minutes is None:
+                # Workers that never shut down would idle forever
+                break
+        return self.results()
+
+    def results(self) -> Dict:
+        makespan = max(self.finished_at.values(), default=0.0)
+        end = max([makespan] + [worker['stopped_at'] or 0 for worker in self.workers])
+        uptime = sum((worker['stopped_at'] if worker['stopped_at'] is not None else end) - worker['started_at'] for worker in self.workers)
+        busy = sum(worker['busy_seconds'] for worker in self.workers)
+        return {
+            'makespan_hours': makespan / 3600,
+            'gpu_hours': uptime / 3600,
+            'busy_gpu_hours': busy / 3600,
+            'idle_gpu_hours': (uptime - busy) / 3600,
+            'utilization': busy / uptime if uptime else 0.0,
+            'workers_started': len(self.workers),
+            'tasks_done': len(self.finished_at),
+            'tasks_not_run': len(self.tasks) - len(self.finished_at),
+            'api_calls': sum(self.api_calls.values()),
+            'api_calls_by_step': dict(self.api_calls),
+        }
+
+
+def print_results(runs: List[Dict]):
+    print(f"Results of {len(runs)} run(s) (mean, min - max):")
+    for key in ['makespan_hours', 'gpu_hours', 'busy_gpu_hours', 'idle_gpu_hours', 'utilization', 'workers_started', 'tasks_done', 'tasks_not_run', 'api_calls']:
+        values = [run[key] for run in runs]
+        print(f"  {key:<18}{sum(values) / len(values):>12.2f}   ({min(values):.2f} - {max(values):.2f})")
+    steps = sorted({step for run in runs for step in run['api_calls_by_step']})
+    for step in steps:
+        values = [run['api_calls_by_step'].get(step, 0) for run in runs]
+        print(f"    {step:<16}{sum(values) / len(values):>12.0f}")
+
+
+def simulate(file_path, durations=None, traces=None, workers=0, runs=1, seed=0, autoscale=True, boot_min=3,
+             model_load_min=10, default_min=60, scale_max=None, wait_between_scales_min=None, after_idle_minutes=None,
+             cache_weight=None, candidates=None, max_hours=24 * 30):
+    """
+    Simulate workers and the autoscaler working through the sweep in file_path.
+    Arguments:
+        durations: yaml file with durations in minutes per stage or title ('*' for all others)
+        traces: trace files or directories (e.g. a pulled sweep with attached trace.jsonl files)
+        workers: workers running from the start, in addition to those the autoscaler starts
+        runs: number of simulations with different random seeds
+        boot_min: minutes from a scale up until the new worker takes tasks
+        model_load_min: minutes to load each model of a task that is not cached on the worker
+        default_min: minutes per unit of priority_weight for stages without a known duration
+        scale_max, wait_between_scales_min, after_idle_minutes, cache_weight, candidates: override experisana.yaml
+    """
+    config = load_config()
+    for section, key, value in [('scale', 'max', scale_max), ('scale', 'wait_between_scales_min', wait_between_scales_min),
+                                ('shutdown', 'after_idle_minutes', after_idle_minutes),
+                                ('scheduling', 'cache_weight', cache_weight), ('scheduling', 'candidates', candidates)]:
+        if value is not None:
+            config[section] = {**(config.get(section) or {}), key: value}
+    if not workers and not (autoscale and config.get('scale')):
+        raise ValueError("Simulate with --workers > 0 or a `scale` section in experisana.yaml")
+
+    jobs, priorities = expand_sweep(file_path)
+    duration_specs = {}
+    if durations:
+        with open(durations, "r") as f:
+            duration_specs = yaml.safe_load(f) or {}
+    trace_durations, overheads = {}, []
+    if traces:
+        trace_durations, overheads = durations_from_traces(traces if isinstance(traces, (list, tuple)) else [traces], jobs)
+        print(f"Durations from traces: {', '.join(f'{stage}: {len(d)} runs' for stage, d in trace_durations.items()) or 'none'}")
+
+    print(f"Simulating {len(jobs)} tasks with scale: {config.get('scale')}, shutdown: {config.get('shutdown')}, scheduling: {config.get('scheduling')}")
+    results = []
+    for run in range(runs):
+        random.seed(seed + run)
+        simulation = Simulation(jobs, config, duration_specs, trace_durations, overheads, workers, autoscale,
+                                boot_min, model_load_min, default_min, max_hours)
+        results.append(simulation.run())
+    print_results(results)
+
+
+if __name__ == "__main__":
+    fire.Fire(simulate)
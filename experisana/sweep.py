@@ -0,0 +1,240 @@
+"""Expansion of a sweep yaml into jobs, without talking to Asana.
+
+`experisana schedule` creates one task per expanded job, and `experisana simulate`
+replays the same jobs offline.
+"""
+import os
+import re
+import json
+import random
+import itertools
+from typing import List, Dict, Tuple
+import yaml
+
+
+def load_yaml(file_path: str) -> Dict:
+    with open(file_path, 'r') as file:
+        config = yaml.safe_load(file)
+        if 'sweep' not in config and 'default' in config:
+            config['sweep'] = config.pop('default')
+        if 'stages' not in config:
+            default_stage_name = file_path.split('/')[-1].split('.')[0]
+            config['stages'] = [{'name': default_stage_name}]
+        return config
+
+def substitute_variables(value: str, context: dict[str, str]) -> str:
+    """
+    Fills the value with data from the context.
+    Example:
+        value = "{some_nested_{var}}"
+        context = {'var': 1, 'some_nested_1': 'yey', 'some_nested_2': 'oops'}
+        # Returns: 'yey'
+    Arguments:
+        value: string to be filled with values from the context
+        context: dict
+    Returns:
+        str: value filled with data from the context
+        accessed_variables: a dict of {variable: value} that were accessed
+    """
+    prev = ''
+    accessed_variables = {}
+    while value != prev:
+        prev = value
+        for key, val in context.items():
+            if isinstance(val, dict):
+                # Handle nested dictionaries
+                for nested_key, nested_val in val.items():
+                    replace_key = f"{key}.{nested_key}"
+                    if replace_key in value:
+                        value = value.replace(f"{{{key}.{nested_key}}}", str(nested_val))
+                        accessed_variables[replace_key] = nested_val
+            elif f"{{{key}}}" in value:
+                accessed_variables[key] = val
+                value = value.replace(f"{{{key}}}", str(val))
+    return value, accessed_variables
+
+def dict_to_hash(d):
+    """Takes a dictionary and returns a deterministic hash"""
+    keys = sorted(d.keys(), key=str)
+    return hash(frozenset((key, d[key]) for key in keys))
+
+def resolve_dependencies(value: str, jobs_context: Dict[str, Dict[str, str]]) -> str:
+    pattern = re.compile(r'\$\((\w+)\.(\w+)\)')
+    return pattern.sub(lambda match: jobs_context[match.group(1)][match.group(2)], value)
+
+# Priority bonus per job that (transitively) waits for a job
+FANOUT_WEIGHT = 0.1
+
+def compute_priorities(dependencies: Dict[str, List[str]], weights: Dict[str, float]) -> Dict[str, float]:
+    """
+    Critical-path priorities for a DAG of jobs.
+    Arguments:
+        dependencies: {job: [jobs it depends on]}
+        weights: {job: expected duration}, defaults to 1
+    Returns:
+        {job: longest remaining path (incl. the job itself) + FANOUT_WEIGHT * number of descendants}
+    """
+    dependents = {job: [] for job in dependencies}
+    for job, parents in dependencies.items():
+        for parent in parents:
+            dependents.setdefault(parent, []).append(job)
+
+    remaining_path, descendants = {}, {}
+    def visit(job):
+        if job not in remaining_path:
+            remaining_path[job] = 0  # guards against cycles
+            children = dependents.get(job, [])
+            for child in children:
+                visit(child)
+            remaining_path[job] = weights.get(job, 1) + max((remaining_path[c] for c in children), default=0)
+            descendants[job] = set(children).union(*[descendants.get(c, set()) for c in children])
+        return remaining_path[job]
+
+    for job in dependents:
+        visit(job)
+    return {job: round(remaining_path[job] + FANOUT_WEIGHT * len(descendants[job]), 3) for job in dependents}
+
+def simulate_makespan(jobs: Dict[str, Dict], workers: int = 1, order: str = 'priority') -> float:
+    """
+    List-scheduling simulation of a sweep: whenever a worker is free, it starts the ready job with the highest
+    priority (or a random one for order='random').
+    Arguments:
+        jobs: {job id: {'duration': float, 'depends_on': [job ids], 'priority': float}}
+    Returns:
+        time at which the last job finishes
+    """
+    finished_at = {}
+    running = []  # (end time, title)
+    now = 0.0
+    while len(finished_at) < len(jobs):
+        started = {title for _, title in running}
+        ready = [title for title, job in jobs.items()
+                 if title not in finished_at and title not in started
+                 and all(dep in finished_at or dep not in jobs for dep in job['depends_on'])]
+        if order == 'random':
+            random.shuffle(ready)
+        else:
+            ready.sort(key=lambda title: jobs[title]['priority'], reverse=True)
+        for title in ready[:workers - len(running)]:
+            running.append((now + jobs[title]['duration'], title))
+        if not running:
+            raise ValueError("Jobs have cyclic dependencies")
+        running.sort()
+        now, title = running.pop(0)
+        finished_at[title] = now
+    return now
+
+def generate_combinations(parameters: Dict[str, List[str]]) -> List[Dict[str, str]]:
+    keys, values = zip(*parameters.items())
+    return [dict(zip(keys, combination)) for combination in itertools.product(*values)]
+
+def flatten_dict(d: Dict, parent_key: str = '', sep: str = '.') -> Dict:
+    items = []
+    for k, v in d.items():
+        new_key = f"{parent_key}{sep}{k}" if parent_key else k
+        if isinstance(v, dict):
+            items.extend(flatten_dict(v, new_key, sep=sep).items())
+        else:
+            items.append((new_key, v))
+    return dict(items)
+
+
+def format_notes(script: str, dependency_gids: List, context: Dict = None, priority: float = None, pack: Dict = None, timeout_min: float = None, workspace_gid: str = None) -> str:
+    """Task notes as parsed by the worker. dependency_gids is a list of (job name, gid or None)"""
+    notes = f"# Script\n{script}\n\n# Depends on\n"
+    for dependency, dependency_gid in dependency_gids:
+        if dependency_gid:
+            notes += f"- {dependency} (https://app.asana.com/0/{workspace_gid}/{dependency_gid})\n"
+        else:
+            notes += f"- {dependency} (GID not found)\n"
+
+    if priority is not None:
+        notes += f"\n# Priority: {priority:g}\n"
+
+    if pack:
+        notes += f"\n# Pack: {pack['group']} (max {pack['max']}, parallel {pack['parallel']})\n"
+
+    if timeout_min:
+        notes += f"\n# Timeout: {float(timeout_min):g} min\n"
+
+    if context:
+        notes += f"\n# Context\n```json\n{json.dumps(context, indent=2)}\n```"
+    return notes
+
+
+def expand_sweep(file_path: str) -> Tuple[List[Dict], Dict[str, float]]:
+    """
+    Expand all combinations of the sweep in file_path into jobs.
+    Returns:
+        jobs: list of {'id' (index in jobs), 'job_name', 'title' (not unique without a per-stage model_id),
+            'script', 'context' (the variables used by the script), 'dependencies' (job names),
+            'depends_on' ([(job name, id of the latest job of that stage or None)], like `schedule` links them),
+            'priority', 'weight' (the stage's priority_weight), 'tags', 'pack', 'timeout_min', 'level'},
+            without jobs whose script variables repeat an earlier job
+        priorities: {stage name: critical-path priority}
+    """
+    config = load_yaml(file_path)
+
+    script_template = config['script']
+    sweep_context = config['sweep']
+    stages = config['stages']
+
+    # Handle nested parameters
+    flat_sweep_context = flatten_dict(sweep_context)
+    list_parameters = {k: v for k, v in flat_sweep_context.items() if isinstance(v, list)}
+    if list_parameters:
+        combinations = generate_combinations(list_parameters)
+    else:
+        combinations = [{}]
+
+    jobs_context = {}
+    jobs_dependencies = {}
+    jobs = []
+
+    # Stages on long dependency chains get a higher priority, so workers start them first
+    stage_dependencies = {stage['name']: [match.group(1) for match in re.finditer(r'\$\(([a-zA-Z0-9_-]+)\.\w+\)', str(stage))] for stage in stages}
+    stage_weights = {stage['name']: float(stage.get('priority_weight', 1)) for stage in stages}
+    priorities = compute_priorities(stage_dependencies, stage_weights)
+
+    unique_keys = set()
+    # Latest job per stage, so that dependencies point to the job of the same combination
+    job_name_to_id = {}
+
+    for combination in combinations:
+        combined_context = {**flat_sweep_context, **combination}
+        for level, stage in enumerate(stages):
+            context = {**combined_context, **stage}
+
+            for nested_level in range(4):
+                for key, value in context.items():
+                    if isinstance(value, str):
+                        context[key], _ = substitute_variables(value, context)
+                        context[key] = resolve_dependencies(context[key], jobs_context)
+
+            job_name = context['name']
+            jobs_context[job_name] = context
+            jobs_dependencies[job_name] = [match.group(1) for match in re.finditer(r'\$\(([a-zA-Z0-9_-]+)\.\w+\)', str(stage))]
+
+            title = context.get('model_id') or job_name
+            script, accessed_variables = substitute_variables(script_template, context)
+            if dict_to_hash(accessed_variables) in unique_keys:
+                continue
+            unique_keys.add(dict_to_hash(accessed_variables))
+            # Jobs of stages with `pack: <n>` may be run in bundles of up to n tasks by one worker
+            pack = None
+            if context.get('pack'):
+                pack = {
+                    'group': re.sub(r'\s+', '-', f"{os.path.basename(file_path)}/{job_name}"),
+                    'max': int(context['pack']),
+                    'parallel': int(context.get('pack_parallel', 1)),
+                }
+            jobs.append({
+                'id': len(jobs), 'job_name': job_name, 'title': title, 'script': script, 'context': accessed_variables,
+                'dependencies': jobs_dependencies[job_name],
+                'depends_on': [(dep, job_name_to_id.get(dep)) for dep in jobs_dependencies[job_name]],
+                'priority': priorities[stage['name']], 'weight': stage_weights[stage['name']],
+                'tags': [i.strip() for i in context.get('tags', '').split(',')],
+                'pack': pack, 'timeout_min': context.get('timeout_min'), 'level': level,
+            })
+            job_name_to_id[job_name] = jobs[-1]['id']
+    return jobs, priorities
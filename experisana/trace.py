@@ -0,0 +1,146 @@
+"""Trace log of the task lifecycle phases and API calls of a worker.
+
+Every span is appended as one JSON line to ~/.experisana/traces/<worker_id>.jsonl:
+    {"name": "execute", "kind": "phase", "task_gid": "123", "worker_id": "...", "start": 1700000000.0, "duration": 12.3, "status": "ok"}
+`experisana profile` aggregates these files into a breakdown of where the time of a sweep went.
+"""
+import os
+import glob
+import json
+import time
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+TRACE_DIR = os.path.expanduser("~/.experisana/traces")
+
+_lock = threading.Lock()
+_local = threading.local()
+_trace_file = None
+_worker_id = None
+# Spans per task, kept until they are attached to the task (only with `trace.attach`)
+_attach = False
+_task_spans = defaultdict(list)
+
+
+def configure(worker_id, trace_dir=None, attach=False):
+    """Start writing spans to <trace_dir>/<worker_id>.jsonl, and keep the spans of each task if they are attached to it"""
+    global _trace_file, _worker_id, _attach
+    trace_dir = os.path.expanduser(trace_dir or TRACE_DIR)
+    os.makedirs(trace_dir, exist_ok=True)
+    _worker_id = worker_id
+    _attach = attach
+    _trace_file = open(os.path.join(trace_dir, f"{worker_id}.jsonl"), "a")
+    print(f"Writing traces to {_trace_file.name}")
+
+
+def set_task(task_gid):
+    """Attribute spans of the current thread (incl. API calls) to a task"""
+    _local.task_gid = task_gid
+
+
+def record_span(name, start, duration, kind="phase", **attrs):
+    if _trace_file is None:
+        return
+    task_gid = attrs.pop('task_gid', None) or getattr(_local, 'task_gid', None)
+    span = {"name": name, "kind": kind, "task_gid": task_gid, "worker_id": _worker_id,
+            "start": round(start, 3), "duration": round(duration, 4), **attrs}
+    with _lock:
+        _trace_file.write(json.dumps(span) + "\n")
+        _trace_file.flush()
+        if _attach and task_gid is not None:
+            _task_spans[task_gid].append(span)
+
+
+def start_span(name, **attrs):
+    return {"name": name, "start": time.time(), "attrs": attrs}
+
+
+def end_span(span, status="ok", **attrs):
+    record_span(span["name"], span["start"], time.time() - span["start"], status=status, **span["attrs"], **attrs)
+
+
+@contextmanager
+def span(name, **attrs):
+    started = start_span(name, **attrs)
+    try:
+        yield
+    except BaseException:
+        end_span(started, status="error")
+        raise
+    end_span(started)
+
+
+def dump_task_spans(task_gid, file_path):
+    """Write all spans of a task to file_path (to attach them to the task) and forget them"""
+    with _lock:
+        spans = _task_spans.pop(task_gid, [])
+    with open(file_path, "w") as f:
+        for s in spans:
+            f.write(json.dumps(s) + "\n")
+    return file_path
+
+
+def load_spans(paths):
+    spans = []
+    for path in paths:
+        if not os.path.exists(path):
+            print(f"Skipping {path}: not found")
+            continue
+        files = glob.glob(os.path.join(path, "**", "*.jsonl"), recursive=True) if os.path.isdir(path) else [path]
+        for file in files:
+            with open(file, "r") as f:
+                for line in f:
+                    try:
+                        spans.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        continue
+    return spans
+
+
+def profile(*paths):
+    """
+    Aggregate trace files into time per phase and per API endpoint.
+    Arguments:
+        paths: trace files or directories (e.g. pulled task folders with attached trace.jsonl files),
+            defaults to all traces of this machine
+    """
+    spans = load_spans(paths or [TRACE_DIR])
+    if not spans:
+        print("No spans found.")
+        return
+
+    phases = defaultdict(list)
+    endpoints = defaultdict(list)
+    endpoint_errors = defaultdict(int)
+    rate_limited = 0
+    for s in spans:
+        if s.get("kind") == "api":
+            endpoints[s["name"]].append(s["duration"])
+            if str(s.get("status")) != "ok" and not str(s.get("status", "")).startswith("2"):
+                endpoint_errors[s["name"]] += 1
+            rate_limited += str(s.get("status")) == "429"
+        else:
+            phases[s["name"]].append(s["duration"])
+
+    tasks = {s["task_gid"] for s in spans if s.get("task_gid")}
+    total_phase_time = sum(sum(d) for name, d in phases.items() if name != "backoff") or 1
+    print(f"Phases ({len(tasks)} tasks, {len({s.get('worker_id') for s in spans})} workers):")
+    print(f"{'phase':<16}{'count':>8}{'total [s]':>12}{'mean [s]':>10}{'max [s]':>10}{'share':>8}")
+    for name, durations in sorted(phases.items(), key=lambda item: -sum(item[1])):
+        share = f"{sum(durations) / total_phase_time:.0%}" if name != "backoff" else ""
+        print(f"{name:<16}{len(durations):>8}{sum(durations):>12.1f}{sum(durations) / len(durations):>10.2f}{max(durations):>10.1f}{share:>8}")
+
+    print("\nAPI endpoints:")
+    print(f"{'endpoint':<48}{'calls':>8}{'errors':>8}{'total [s]':>12}{'mean [s]':>10}")
+    for name, durations in sorted(endpoints.items(), key=lambda item: -sum(item[1])):
+        print(f"{name:<48}{len(durations):>8}{endpoint_errors[name]:>8}{sum(durations):>12.1f}{sum(durations) / len(durations):>10.3f}")
+
+    compute = sum(phases.get("execute", []))
+    io = sum(sum(phases.get(name, [])) for name in ["download", "uploads", "log_post"])
+    overhead = sum(sum(phases.get(name, [])) for name in ["claim", "setup", "move"])
+    backoff_time = sum(phases.get("backoff", []))
+    verdict = max([("compute-bound", compute), ("I/O-bound", io), ("dominated by board overhead", overhead)], key=lambda x: x[1])[0]
+    print(f"\nExecute: {compute:.0f}s, transfers: {io:.0f}s, claim/setup/move: {overhead:.0f}s -> {verdict}")
+    if rate_limited or backoff_time:
+        print(f"Rate limited: {rate_limited} requests got 429, {backoff_time:.0f}s spent in backoff")
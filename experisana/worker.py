@@ -1,16 +1,41 @@
-import random
+import re
 import asana
 import os
 import subprocess
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import time
 from dotenv import load_dotenv
 import requests
 from requests.exceptions import RequestException
 from asana.rest import ApiException
 import backoff
-import yaml
 import threading
+import shutil
+import socket
+import signal
+import json
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, List
+from experisana.aio import AsyncAsanaClient
+from experisana.metrics import inc, observe, count_retry, instrument_api_client, start_metrics_server
+from experisana import trace
+from experisana.resources import ResourceSampler
+from experisana.cache import get_cache_settings, calculate_cache_score, lookup_cache, record_cache_usage
+from experisana.archive import get_archive_settings, pack_directory, unpack_all
+from experisana.config import load_config
+from experisana import policy
+from experisana.policy import (
+    extract_context_from_notes,
+    extract_pack_from_notes,
+    get_task_dependencies,
+    task_in_section,
+    extract_attempts_from_notes,
+    is_backing_off,
+    parse_projects,
+    fair_share_order,
+    should_shut_down,
+)
 
 load_dotenv(override=True)
 
@@ -18,12 +43,16 @@ load_dotenv(override=True)
 ACCESS_TOKEN = os.getenv("ASANA_ACCESS_TOKEN")
 WORKSPACE_GID = os.getenv("ASANA_WORKSPACE_GID")
 PROJECT_GID = os.getenv("ASANA_PROJECT_GID")
+if not PROJECT_GID and os.getenv("ASANA_PROJECT_GIDS"):
+    # With several boards, the first one is the home board where workers register and jobs are scheduled
+    PROJECT_GID = os.getenv("ASANA_PROJECT_GIDS").split(",")[0].split(":")[0].strip()
 
 expected_envs = [
     "ASANA_ACCESS_TOKEN",
     "ASANA_WORKSPACE_GID",
-    "ASANA_PROJECT_GID"
 ]
+if not PROJECT_GID:
+    expected_envs.append("ASANA_PROJECT_GID")
 if not all([os.getenv(i) for i in expected_envs]):
     missing = [i for i in expected_envs if not os.getenv(i)]
     raise Exception(f"Missing environment variables: {missing}")
@@ -35,41 +64,21 @@ opts = {
 # Set up Asana API client
 configuration = asana.Configuration()
 configuration.access_token = ACCESS_TOKEN
-api_client = asana.ApiClient(configuration)
+api_client = instrument_api_client(asana.ApiClient(configuration))
 tasks_api_instance = asana.TasksApi(api_client)
 sections_api_instance = asana.SectionsApi(api_client)
 attachments_api_instance = asana.AttachmentsApi(api_client)
 stories_api_instance = asana.StoriesApi(api_client)
+batch_api_instance = asana.BatchAPIApi(api_client)
 
-
-def load_config():
-    """Check for experisana.yaml in [./, ../, ...]"""
-    cwd = os.getcwd()
-    config = {}
-    while cwd != "/":
-        config_path = os.path.join(cwd, "experisana.yaml")
-        if os.path.exists(config_path):
-            config = yaml.safe_load(open(config_path, "r"))
-        cwd = os.path.dirname(cwd)
-
-    # A bit of custom logic for imo-experiment
-    for config_path in ["/workspace/experisana.yaml", "/Users/nielswarncke/Documents/code/asana-worker/experisana.yaml"]:
-        if os.path.exists(config_path):
-            config = yaml.safe_load(open(config_path, "r"))
-
-    # Initialize cache if not present
-    if 'cache' not in config:
-        config['cache'] = {
-            'base_model': [],
-            'model_id': []
-        }
-    return config
 CONFIG = load_config()
+CACHE_SETTINGS = get_cache_settings(CONFIG)
+ARCHIVE_SETTINGS = get_archive_settings(CONFIG)
 
-@backoff.on_exception(backoff.expo, (ApiException), max_tries=100)
-def get_column_gids():
+@backoff.on_exception(backoff.expo, (ApiException), max_tries=100, on_backoff=count_retry)
+def get_column_gids(project_gid=None):
     try:
-        sections = sections_api_instance.get_sections_for_project(PROJECT_GID, opts=opts)
+        sections = sections_api_instance.get_sections_for_project(project_gid or PROJECT_GID, opts=opts)
         column_gids = {}
         for section in sections:
             column_gids[section['name']] = section['gid']
@@ -82,6 +91,38 @@ column_gids = get_column_gids()
 
 BACKLOG_COLUMN_GID = column_gids.get("Backlog", None)
 
+# Section maps of all boards this process has worked with, fetched on first use
+project_column_gids = {PROJECT_GID: column_gids}
+
+def get_project_columns(project_gid):
+    if project_gid not in project_column_gids:
+        project_column_gids[project_gid] = get_column_gids(project_gid)
+    return project_column_gids[project_gid]
+
+def get_projects(projects=None) -> List[Dict]:
+    """Boards this worker serves with their fair-share weights: from the argument, `projects` in
+    experisana.yaml or ASANA_PROJECT_GIDS, defaulting to the home board"""
+    return parse_projects(projects or CONFIG.get('projects') or os.getenv("ASANA_PROJECT_GIDS") or PROJECT_GID)
+
+# Attachments of the task we expect to run next are downloaded here while the current task runs
+STAGING_DIR = os.path.join("/tmp", "experisana_staging")
+# Posts logs and uploads results of finished tasks in pipeline mode, a few tasks at a time
+upload_executor = ThreadPoolExecutor(max_workers=2)
+pending_uploads = []
+
+# Unix socket of the host-local board-sync daemon (`experisana daemon`), if this worker uses one
+DAEMON_SOCKET = None
+
+def daemon_request(op, **params):
+    """Send a request to the board-sync daemon and return its result"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(DAEMON_SOCKET)
+        sock.sendall((json.dumps({'op': op, **params}) + "\n").encode())
+        response = json.loads(sock.makefile("r").readline())
+    if 'error' in response:
+        raise RequestException(f"Daemon request {op} failed: {response['error']}")
+    return response['result']
+
 def get_or_create_worker_id():
     worker_id_path = os.path.expanduser("~/worker_id")
     if os.path.exists(worker_id_path):
@@ -93,107 +134,73 @@ def get_or_create_worker_id():
             f.write(worker_id)
     return worker_id
 
-@backoff.on_exception(backoff.expo, (ApiException, RequestException), max_tries=100)
+@backoff.on_exception(backoff.expo, (ApiException, RequestException), max_tries=100, on_backoff=count_retry)
 def get_task_details(task_gid):
     return tasks_api_instance.get_task(task_gid, opts)
 
-def get_task_dependencies(task):
-    dependencies = []
-    if 'notes' in task:
-        notes_lines = task['notes'].split('\n')
-        for line in notes_lines:
-            if line.startswith('- '):
-                dependency = line.split('/')[-1].replace(')', '')
-                dependencies.append(dependency)
-    return dependencies
-
-@backoff.on_exception(backoff.expo, (ApiException, RequestException), max_tries=100)
+@backoff.on_exception(backoff.expo, (ApiException, RequestException), max_tries=100, on_backoff=count_retry)
 def is_task_done(task_gid, done_column_gid):
     try:
         task = get_task_details(task_gid)
         if task is None:
             return False
-        return task['memberships'][0]['section']['gid'] == done_column_gid
+        return task_in_section(task, done_column_gid)
     except ApiException as e:
         print(f"Exception when checking task status: {e}")
         raise
 
-import json
-import re
-from typing import Dict, Optional, List
+def select_runnable_task(tasks, is_done, exclude=(), worker_id=None):
+    """policy.select_runnable_task with the scheduling settings and the model cache of this host"""
+    return policy.select_runnable_task(tasks, is_done, exclude, worker_id, CONFIG.get('scheduling', {}),
+                                       lambda context: calculate_cache_score(context, CACHE_SETTINGS))
 
-def extract_context_from_notes(notes: str) -> Optional[Dict]:
-    """Extract the JSON context from task notes."""
-    context_match = re.search(r'# Context\n```json\n(.*?)\n```', notes, re.DOTALL)
-    if context_match:
-        try:
-            return json.loads(context_match.group(1))
-        except json.JSONDecodeError:
-            return None
-    return None
+def get_command(task) -> str:
+    command = task['notes'].strip().split("# Depends on")[0].strip().split("# Assigned to:")[0].strip()
+    # Prepend 'set -e' to ensure the shell exits if any command fails
+    return f"set -e; {command}"
 
-def calculate_cache_score(task_context: Dict, worker_cache: Dict[str, List[str]]) -> int:
-    """Calculate how many cached items match the task context."""
-    if not task_context:
-        return 0
-    
-    score = 0
-    for cache_key, cached_values in worker_cache.items():
-        if cache_key in task_context and task_context[cache_key] in cached_values:
-            score += 1
-    return score
-
-def update_cache(context: Dict, config: Dict) -> Dict:
-    """Update the worker's cache with new values from the task context."""
-    for cache_key in config['cache'].keys():
-        if cache_key in context:
-            if context[cache_key] not in config['cache'][cache_key]:
-                config['cache'][cache_key].append(context[cache_key])
-    
-    # Save the updated config
-    config_path = os.path.join(os.getcwd(), "experisana.yaml")
-    with open(config_path, "w") as f:
-        yaml.dump(config, f)
-    
-    return config
+def record_queue_wait(task):
+    """Time from task creation until a worker claimed it"""
+    if task.get('created_at'):
+        created_at = datetime.fromisoformat(str(task['created_at']).replace('Z', '+00:00'))
+        observe("experisana_queue_wait_seconds", (datetime.now(created_at.tzinfo) - created_at).total_seconds())
 
-@backoff.on_exception(backoff.expo, (ApiException, RequestException), max_tries=5)
-def get_backlog_task(backlog_column_gid, done_column_gid):
-    tasks = tasks_api_instance.get_tasks_for_section(backlog_column_gid, {"limit": 1})
-    
-    # Score each task based on cache hits
-    scored_tasks = []
-    for task in tasks:
-        try:
-            task_details = get_task_details(task['gid'])
-            dependencies = get_task_dependencies(task_details)
-            
-            # Skip tasks with unmet dependencies
-            if not all(is_task_done(dep, done_column_gid) for dep in dependencies):
-                continue
-                
-            # Extract context and calculate cache score
-            context = extract_context_from_notes(task_details['notes'])
-            score = calculate_cache_score(context, CONFIG['cache'])
-            scored_tasks.append((score, task_details))
-            
-        except ApiException as e:
-            print(f"Exception when scoring task: {e}")
-            continue
-    
-    if not scored_tasks:
+@backoff.on_exception(backoff.expo, (ApiException, RequestException), max_tries=5, on_backoff=count_retry)
+def get_backlog_task(backlog_column_gid, done_column_gid, exclude=(), worker_id=None):
+    # The daemon only mirrors the home board
+    if DAEMON_SOCKET and backlog_column_gid == column_gids["Backlog"]:
+        return daemon_request('get_task', exclude=list(exclude), worker_id=worker_id)
+    tasks = tasks_api_instance.get_tasks_for_section(backlog_column_gid, {"limit": 100, "opt_fields": "name,notes"})
+    task = select_runnable_task(tasks, lambda dep: is_task_done(dep, done_column_gid), exclude, worker_id)
+    if task is None:
         return None
-    
-    # Sort by score (highest first) and randomly select among tasks with the same highest score
-    scored_tasks.sort(key=lambda x: x[0], reverse=True)
-    highest_score = scored_tasks[0][0]
-    best_tasks = [task for score, task in scored_tasks if score == highest_score]
-    
-    return random.choice(best_tasks)
+    return get_task_details(task['gid'])
 
 
-@backoff.on_exception(backoff.expo, (ApiException, RequestException), max_tries=5)
-def assign_task_to_worker(task_gid, worker_id):
+@backoff.on_exception(backoff.expo, (ApiException, RequestException), max_tries=5, on_backoff=count_retry)
+def count_tasks_in_section(section_gid):
+    return len(list(tasks_api_instance.get_tasks_for_section(section_gid, {"limit": 100, "opt_fields": "gid"})))
+
+def get_next_task(projects, worker_id=None):
+    """Returns (section map of the project, task) for the next task to run, or (None, None).
+    With several projects, the one with the fewest running tasks per unit of weight goes first."""
+    if len(projects) == 1:
+        columns = get_project_columns(projects[0]['gid'])
+        return columns, get_backlog_task(columns["Backlog"], columns["Done"], worker_id=worker_id)
+    running_counts = {project['gid']: count_tasks_in_section(get_project_columns(project['gid'])["Running"]) for project in projects}
+    for project in fair_share_order(projects, running_counts):
+        columns = get_project_columns(project['gid'])
+        task = get_backlog_task(columns["Backlog"], columns["Done"], worker_id=worker_id)
+        if task:
+            inc("experisana_tasks_selected_total", project=project['gid'])
+            return columns, task
+    return None, None
+
+@backoff.on_exception(backoff.expo, (ApiException, RequestException), max_tries=5, on_backoff=count_retry)
+def assign_task_to_worker(task_gid, worker_id, running_column_gid=None):
+    running_column_gid = running_column_gid or column_gids["Running"]
+    if DAEMON_SOCKET and running_column_gid == column_gids["Running"]:
+        return daemon_request('claim', task_gid=task_gid, worker_id=worker_id)
     try:
         # Get the current task details
         task = get_task_details(task_gid)
@@ -211,7 +218,7 @@ def assign_task_to_worker(task_gid, worker_id):
         updated_task = tasks_api_instance.update_task(update_data, task_gid, opts)
         
         # Move the task to the Running column
-        move_task_to_column(task_gid, column_gids["Running"])
+        move_task_to_column(task_gid, running_column_gid)
         
         # Check if the assignment was successful
         final_task = get_task_details(task_gid)
@@ -223,12 +230,167 @@ def assign_task_to_worker(task_gid, worker_id):
         print(f"Exception when assigning task to worker: {e}")
         raise
 
+def get_preemption_settings():
+    """How jobs are stopped when their task leaves Running or times out (`preemption` in experisana.yaml)"""
+    settings = CONFIG.get('preemption', {})
+    return {
+        'signal': getattr(signal, settings.get('signal', 'SIGTERM')),
+        'grace_seconds': settings.get('grace_seconds', 60),
+        'status_check_seconds': settings.get('status_check_seconds', 15),
+        'timeout_min': settings.get('timeout_min', None),
+    }
+
+def extract_timeout_from_notes(notes: str) -> Optional[float]:
+    """Extract the wall-clock timeout in minutes that `schedule` writes into the task notes."""
+    timeout_match = re.search(r'^# Timeout: ([0-9.]+) min$', notes, re.MULTILINE)
+    if timeout_match:
+        return float(timeout_match.group(1))
+    return get_preemption_settings()['timeout_min']
+
+def process_group_alive(pgid):
+    """Whether any process of the group is still running (zombies that nobody reaped don't count)"""
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat", "r") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        if int(fields[2]) == pgid and fields[0] != 'Z':
+            return True
+    return False
+
+def kill_process_group(pgid):
+    """SIGKILL everything that is left in a job's process group, e.g. GPU processes started by the job"""
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+def stop_process_group(process, sig=signal.SIGTERM, grace_seconds=60):
+    """Send sig to the whole process group of a job so it can checkpoint, then kill it after the grace period"""
+    try:
+        os.killpg(process.pid, sig)
+    except (ProcessLookupError, PermissionError):
+        return
+    deadline = time.time() + grace_seconds
+    while time.time() < deadline:
+        process.poll()  # reap the shell, so that it doesn't keep the group alive as a zombie
+        if not process_group_alive(process.pid):
+            return
+        time.sleep(1)
+    print(f"Process group {process.pid} did not stop within {grace_seconds}s. Killing it.")
+    kill_process_group(process.pid)
+    process.wait()
+
+# Failures that are usually caused by the host or the network rather than by the job itself
+DEFAULT_RETRYABLE_PATTERNS = [
+    r"CUDA out of memory",
+    r"CUDA error: out of memory",
+    r"NCCL error",
+    r"Connection (reset|refused|aborted)",
+    r"Read timed out",
+    r"Temporary failure in name resolution",
+    r"(502|503|504) Server Error",
+    r"No space left on device",
+    r"Failed to download attachments",
+]
+DEFAULT_PERMANENT_PATTERNS = [
+    r"SyntaxError",
+    r"ModuleNotFoundError",
+    r"command not found",
+]
+
+def get_retry_settings():
+    """When failed tasks are requeued instead of moved to Failed (`retry` in experisana.yaml)"""
+    settings = CONFIG.get('retry', {})
+    return {
+        'max_attempts': settings.get('max_attempts', 3),
+        # Timed out jobs resume from their checkpoints, so they get their own, larger limit
+        'max_timeouts': settings.get('max_timeouts', 5),
+        'backoff_min': settings.get('backoff_min', 5),
+        'retryable_patterns': settings.get('retryable_patterns', DEFAULT_RETRYABLE_PATTERNS),
+        'permanent_patterns': settings.get('permanent_patterns', DEFAULT_PERMANENT_PATTERNS),
+        # 128 + SIGKILL/SIGTERM: OOM killer or spot preemption
+        'retryable_exit_codes': settings.get('retryable_exit_codes', [137, 143]),
+    }
+
+def classify_failure(log_file_path, returncode, settings, tail_lines=200):
+    """('retryable' or 'permanent', reason) from the end of the log and the exit code. Permanent patterns win."""
+    try:
+        with open(log_file_path, "r", errors="replace") as log_file:
+            log_tail = ''.join(log_file.readlines()[-tail_lines:])
+    except OSError:
+        log_tail = ''
+    for pattern in settings['permanent_patterns']:
+        if re.search(pattern, log_tail):
+            return 'permanent', pattern
+    for pattern in settings['retryable_patterns']:
+        if re.search(pattern, log_tail):
+            return 'retryable', pattern
+    # Processes killed by a signal have a negative returncode when they are not run via a shell
+    if returncode is not None and (returncode in settings['retryable_exit_codes'] or 128 - returncode in settings['retryable_exit_codes']):
+        return 'retryable', f"exit code {returncode}"
+    return 'permanent', f"exit code {returncode}"
+
+def plan_retry(notes, worker_id, status, log_file_path, returncode, settings=None):
+    """Decide whether a failed or timed out run is requeued.
+    Returns (retry, notes with the attempt appended, reason)."""
+    settings = settings or get_retry_settings()
+    attempts = extract_attempts_from_notes(notes)
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    if status == 'timeout':
+        timeouts = sum(attempt['status'] == 'timeout' for attempt in attempts) + 1
+        retry = timeouts < settings['max_timeouts']
+        reason = f"timeout {timeouts}/{settings['max_timeouts']}"
+    else:
+        kind, pattern = classify_failure(log_file_path, returncode, settings)
+        failures = sum(attempt['status'] == 'failed' for attempt in attempts) + 1
+        retry = kind == 'retryable' and failures < settings['max_attempts']
+        reason = f"{kind}: {pattern}, failure {failures}/{settings['max_attempts']}"
+        inc("experisana_task_failures_total", kind=kind)
+    notes = notes.strip() + f"\n# Attempt {len(attempts) + 1}: {status} on {worker_id} at {now.isoformat()} ({reason})"
+    if retry and status == 'failed' and settings['backoff_min']:
+        # Exponential backoff, so that e.g. a flaky download has time to recover
+        backoff_min = settings['backoff_min'] * 2 ** (failures - 1)
+        notes += f"\n# Not before: {(now + timedelta(minutes=backoff_min)).isoformat()}"
+    return retry, notes, reason
+
+@backoff.on_exception(backoff.expo, (ApiException, RequestException), max_tries=5, on_backoff=count_retry)
+def update_task_notes(task_gid, notes):
+    if DAEMON_SOCKET:
+        return daemon_request('notes', task_gid=task_gid, notes=notes)
+    try:
+        tasks_api_instance.update_task({"data": {"notes": notes}}, task_gid, opts)
+    except ApiException as e:
+        print(f"Exception when updating task notes: {e}")
+        raise
+
+def record_attempt(task_gid, worker_id, status, log_file_path, returncode):
+    """Append the attempt to the task notes and return (retry, reason)"""
+    try:
+        retry, notes, reason = plan_retry(get_task_details(task_gid)['notes'], worker_id, status, log_file_path, returncode)
+        update_task_notes(task_gid, notes)
+    except Exception as e:
+        print(f"Exception when recording attempt: {e}")
+        return status == 'timeout', str(e)
+    if retry:
+        inc("experisana_task_retries_total", status=status)
+    print(f"Task {task_gid} {status} ({reason}). {'Requeueing it.' if retry else 'Not retrying.'}")
+    return retry, reason
+
 def check_task_status(task_gid, running_column_gid, stop_event):
+    interval_seconds = get_preemption_settings()['status_check_seconds']
     while not stop_event.is_set():
-        time.sleep(60)  # Check every minute
+        if stop_event.wait(interval_seconds):
+            break
         try:
-            task = get_task_details(task_gid)
-            if task['memberships'][0]['section']['gid'] != running_column_gid:
+            if DAEMON_SOCKET and running_column_gid == column_gids["Running"]:
+                running = daemon_request('section', task_gid=task_gid) == running_column_gid
+            else:
+                running = task_in_section(get_task_details(task_gid), running_column_gid)
+            if not running:
                 stop_event.set()
                 print(f"Task {task_gid} was moved out of the Running column. Interrupting execution.")
                 break
@@ -237,34 +399,154 @@ def check_task_status(task_gid, running_column_gid, stop_event):
         except Exception as e:
             print(f"Error checking task status: {e}")
 
-def run_experiment(task, column_gids, worker_id):
+def staging_dir_for(task_gid):
+    return os.path.join(STAGING_DIR, str(task_gid))
+
+def clear_staging(keep=None):
+    """Remove prefetched attachments of all tasks except `keep`"""
+    if not os.path.isdir(STAGING_DIR):
+        return
+    for name in os.listdir(STAGING_DIR):
+        if name != str(keep):
+            shutil.rmtree(os.path.join(STAGING_DIR, name), ignore_errors=True)
+
+def prefetch_next_task(current_task_gid, backlog_column_gid, done_column_gid, worker_id=None):
+    """Download the attachments of the task we will most likely run next into the staging area.
+    The task is not claimed - that happens only once this worker is free again."""
+    try:
+        task = get_backlog_task(backlog_column_gid, done_column_gid, exclude=(current_task_gid,), worker_id=worker_id)
+        if task is None:
+            return None
+        clear_staging(keep=task['gid'])
+        staging_dir = staging_dir_for(task['gid'])
+        os.makedirs(staging_dir, exist_ok=True)
+        download_attachments(task['gid'], staging_dir)
+        print(f"Prefetched attachments of next task: {task['name']}")
+        return task
+    except Exception as e:
+        print(f"Exception when prefetching next task: {e}")
+        return None
+
+def prepare_task_dir(task_gid, task_dir):
+    """Create the task directory, reusing prefetched attachments if there are any"""
+    staging_dir = staging_dir_for(task_gid)
+    if os.path.isdir(staging_dir):
+        shutil.move(staging_dir, task_dir)
+        print(f"Using prefetched attachments from {staging_dir}")
+        # Only fetch what was attached after the prefetch
+        downloaded = download_attachments(task_gid, task_dir, skip_existing=True)
+    else:
+        clear_staging()
+        os.makedirs(task_dir, exist_ok=True)
+        downloaded = download_attachments(task_gid, task_dir)
+    if downloaded:
+        # Archived uploads of a previous attempt, e.g. checkpoints of a timed out run
+        unpack_all(task_dir)
+    return downloaded
+
+def format_log_comment(log_file_path, status, summary=None):
+    """Returns the comment with the first 100 lines of the logs, and whether the full log should be uploaded"""
+    with open(log_file_path, "r") as log_file:
+        log_lines = log_file.readlines()
+    comment_text = f'Status: {status}\n{summary}\nLogs:\n' if summary else f'Status: {status} with logs:\n'
+    comment_text += ''.join(log_lines[:100])
+    if len(log_lines) > 100:
+        comment_text += f'... and {len(log_lines) - 100} more lines'
+    return comment_text, len(log_lines) > 100
+
+def collect_uploads(task_dir):
+    """Files to attach for task_dir/uploads: the files themselves, or the manifest and parts of its archives"""
+    uploads_dir = os.path.join(task_dir, "uploads")
+    uploads = [os.path.join(root, file) for root, dirs, files in os.walk(uploads_dir) for file in files]
+    if uploads and ARCHIVE_SETTINGS['archive']:
+        try:
+            return pack_directory(uploads_dir, os.path.join(task_dir, "uploads_archive"), "uploads",
+                                  ARCHIVE_SETTINGS['compression'], ARCHIVE_SETTINGS['chunk_mb'])
+        except Exception as e:
+            print(f"Exception when archiving uploads, uploading them one by one: {e}")
+    return uploads
+
+def upload_task_dir(task_gid, task_dir):
+    """Upload all uploads in the task_directory/uploads directory"""
+    for file_path in collect_uploads(task_dir):
+        try:
+            upload_log_to_task(task_gid, file_path)
+        except Exception as e:
+            print(f"Exception when uploading file {file_path}: {e}")
+
+def report_results(task_gid, task_dir, log_file_path, status, summary=None, extra_uploads=()):
+    """Post the head of the logs as a comment and upload everything in task_dir/uploads"""
+    trace.set_task(task_gid)
+    # Read the first 100 lines of the log file and post as a comment
+    try:
+        with trace.span("log_post"):
+            comment_text, upload_full_log = format_log_comment(log_file_path, status, summary)
+            if upload_full_log:
+                upload_log_to_task(task_gid, log_file_path)
+            post_comment_to_task(task_gid, comment_text)
+    except Exception as e:
+        print(f"Exception when reading log file or posting comment: {e}")
+
+    with trace.span("uploads"):
+        upload_task_dir(task_gid, task_dir)
+        for file_path in extra_uploads:
+            try:
+                upload_log_to_task(task_gid, file_path)
+            except Exception as e:
+                print(f"Exception when uploading file {file_path}: {e}")
+
+    if CONFIG.get('trace', {}).get('attach', False):
+        try:
+            upload_log_to_task(task_gid, trace.dump_task_spans(task_gid, os.path.join(task_dir, "trace.jsonl")))
+        except Exception as e:
+            print(f"Exception when attaching trace: {e}")
+    trace.set_task(None)
+
+def report_results_and_move(task_gid, column_gid, *args):
+    """report_results, then move the task, so that dependents only start once the results are attached"""
+    report_results(task_gid, *args)
+    with trace.span("move", task_gid=task_gid):
+        move_task_to_column(task_gid, column_gid)
+
+def wait_for_uploads():
+    """Block until all background uploads of finished tasks are done"""
+    while pending_uploads:
+        try:
+            pending_uploads.pop().result()
+        except Exception as e:
+            print(f"Exception when reporting results in the background: {e}")
+
+def run_experiment(task, column_gids, worker_id, pipeline=False):
     print(f"Running experiment: {task['name']}")
     task_gid = task['gid']
+    trace.set_task(task_gid)
     
     # Try to assign the task to this worker
-    if not assign_task_to_worker(task_gid, worker_id):
+    with trace.span("claim"):
+        claimed = assign_task_to_worker(task_gid, worker_id, column_gids["Running"])
+    if not claimed:
         print(f"Task {task_gid} was assigned to another worker. Skipping.")
+        inc("experisana_claim_conflicts_total")
+        trace.set_task(None)
         return False
-    
-    # Extract context and update cache before running
-    context = extract_context_from_notes(task['notes'])
-    if context:
-        global CONFIG
-        CONFIG = update_cache(context, CONFIG)
+    record_queue_wait(task)
 
-    command = task['notes'].strip().split("# Depends on")[0].strip().split("# Assigned to:")[0].strip()
-    # Prepend 'set -e' to ensure the shell exits if any command fails
-    command = f"set -e; {command}"
+    command = get_command(task)
 
-    # Create a new directory for the task
+    # Create a new directory for the task and download attachments into it
     task_dir = os.path.join("/tmp", f"task_{task_gid}_{datetime.now().strftime('%Y%m%d%H%M%S')}")
-    os.makedirs(task_dir, exist_ok=True)
-
-    # Download attachments to the new directory
-    if not download_attachments(task_gid, task_dir):
+    with trace.span("download"):
+        try:
+            downloaded = prepare_task_dir(task_gid, task_dir)
+        except Exception as e:
+            print(f"Exception when downloading attachments: {e}")
+            downloaded = False
+    if not downloaded:
         print("Failed to download attachments")
+        trace.set_task(None)
         return
 
+    setup_span = trace.start_span("setup")
     move_task_to_column(task_gid, column_gids["Running"])
 
     log_file_path = os.path.join(task_dir, "experiment_logs.txt")
@@ -274,6 +556,14 @@ def run_experiment(task, column_gids, worker_id):
     os.chdir(task_dir)
 
     print(f"Use the following command to watch logs:\n    watch tail {log_file_path}")
+
+    # Extract context and look up which of its models are cached on this host. This marks them as in use
+    # until record_cache_usage, which runs after the job in any case
+    context = extract_context_from_notes(task['notes'])
+    cache_misses = lookup_cache(context, CACHE_SETTINGS)[1]
+    started_at = time.time()
+    sampler = None
+    requeue = False
     with open(log_file_path, "w") as log_file:
         try:
             # Create a stop event and start the status checking thread
@@ -282,63 +572,321 @@ def run_experiment(task, column_gids, worker_id):
             status_thread.start()
 
             print(f"Running command: {command}")
+            trace.end_span(setup_span)
+
+            # Run the command in its own process group, so that interrupts reach all of its children
+            execute_span = trace.start_span("execute")
+            preemption = get_preemption_settings()
+            timeout_min = extract_timeout_from_notes(task['notes'])
+            process = subprocess.Popen(command, shell=True, stdout=log_file, stderr=subprocess.STDOUT, start_new_session=True)
+            resource_settings = CONFIG.get('resources', {})
+            if resource_settings.get('enabled', True):
+                sampler = ResourceSampler(process.pid, resource_settings.get('interval_seconds', 5), resource_settings.get('gpu', True)).start()
 
-            # Run the command with a timeout
-            process = subprocess.Popen(command, shell=True, stdout=log_file, stderr=subprocess.STDOUT)
+            # While the job runs, download the inputs of the next task
+            prefetch_thread = None
+            if pipeline:
+                prefetch_thread = threading.Thread(target=prefetch_next_task, args=(task_gid, column_gids["Backlog"], column_gids["Done"], worker_id), daemon=True)
+                prefetch_thread.start()
             
             while process.poll() is None:
                 if stop_event.is_set():
-                    process.terminate()
-                    process.wait(timeout=10)
                     status = 'interrupted'
-                    break
-                time.sleep(1)
+                elif timeout_min and time.time() - execute_span['start'] > 60 * timeout_min:
+                    print(f"Task {task_gid} exceeded its timeout of {timeout_min} minutes.")
+                    status = 'timeout'
+                else:
+                    time.sleep(1)
+                    continue
+                stop_process_group(process, preemption['signal'], preemption['grace_seconds'])
+                break
             else:
                 status = 'succeeded' if process.returncode == 0 else 'failed'
+            kill_process_group(process.pid)
+
+            observe("experisana_task_runtime_seconds", time.time() - started_at, status=status)
+            trace.end_span(execute_span, status=status)
 
             # Stop the status checking thread
             stop_event.set()
             status_thread.join()
+            if prefetch_thread is not None:
+                prefetch_thread.join()
 
-            if status == 'succeeded':
-                move_task_to_column(task_gid, column_gids["Done"])
-            elif status == 'failed':
-                move_task_to_column(task_gid, column_gids["Failed"])
-            # If interrupted, we don't move the task
+            with trace.span("move"):
+                if status == 'succeeded' and not pipeline:
+                    move_task_to_column(task_gid, column_gids["Done"])
+                elif status in ('failed', 'timeout'):
+                    requeue = record_attempt(task_gid, worker_id, status, log_file_path, process.returncode)[0]
+                    if not requeue:
+                        move_task_to_column(task_gid, column_gids["Failed"])
+                # If interrupted, we don't move the task. Requeued tasks are moved after their checkpoints are uploaded,
+                # and in pipeline mode succeeded tasks are moved to Done after their results are uploaded
 
         except Exception as e:
             print(f"Exception during experiment execution: {e}")
             status = 'failed'
+            requeue = False
             move_task_to_column(task_gid, column_gids["Failed"])
 
-    # Read the first 100 lines of the log file and post as a comment
+    # Change back to the original working directory
+    os.chdir(original_cwd)
+    if sampler is not None:
+        sampler.stop()
+
     try:
-        with open(log_file_path, "r") as log_file:
-            log_lines = log_file.readlines()
-            comment_text = f'Status: {status} with logs:\n' + ''.join(log_lines[:100])
-            if len(log_lines) > 100:
-                comment_text += f'... and {len(log_lines) - 100} more lines'
-                upload_log_to_task(task_gid, log_file_path)
-            post_comment_to_task(task_gid, comment_text)
+        record_cache_usage(context, CACHE_SETTINGS, started_at, cache_misses)
     except Exception as e:
-        print(f"Exception when reading log file or posting comment: {e}")
+        print(f"Exception when updating the cache index: {e}")
 
-    # Upload all uploads in the task_directory/uploads directory
-    for root, dirs, files in os.walk(os.path.join(task_dir, "uploads")):
-        for file in files:
-            try:
-                upload_log_to_task(task_gid, os.path.join(root, file))
-            except Exception as e:
-                print(f"Exception when uploading file {file}: {e}")
+    # Summary of CPU, memory, IO and GPU usage for the comment, all samples as CSV attachment
+    summary, extra_uploads = None, []
+    if sampler is not None and sampler.samples:
+        summary = sampler.summary()
+        extra_uploads.append(sampler.write_csv(os.path.join(task_dir, "resources.csv")))
 
-    # Change back to the original working directory
-    os.chdir(original_cwd)
+    if requeue:
+        # Attach the checkpoints in uploads/ before the task becomes visible to other workers again
+        report_results(task_gid, task_dir, log_file_path, status, summary, extra_uploads)
+        with trace.span("move"):
+            move_task_to_column(task_gid, column_gids["Backlog"])
+        print(f"Requeued task {task_gid} with its checkpoints attached.")
+    elif pipeline:
+        # Upload results in the background while the next job starts
+        pending_uploads[:] = [future for future in pending_uploads if not future.done()]
+        if status == 'succeeded':
+            pending_uploads.append(upload_executor.submit(report_results_and_move, task_gid, column_gids["Done"],
+                                                          task_dir, log_file_path, status, summary, extra_uploads))
+        else:
+            pending_uploads.append(upload_executor.submit(report_results, task_gid, task_dir, log_file_path, status, summary, extra_uploads))
+    else:
+        report_results(task_gid, task_dir, log_file_path, status, summary, extra_uploads)
+    # API calls of the idle loop don't belong to this task
+    trace.set_task(None)
     return status != 'interrupted'
 
 
 
-@backoff.on_exception(backoff.expo, (ApiException, RequestException), max_tries=5)
+def select_bundle_tasks(candidates, group, max_tasks, is_done):
+    """Up to max_tasks runnable candidates of a pack group"""
+    bundle, done = [], {}
+    for candidate in candidates:
+        if len(bundle) >= max_tasks:
+            break
+        if (extract_pack_from_notes(candidate['notes']) or {}).get('group') != group:
+            continue
+        if is_backing_off(candidate):
+            continue
+        dependencies = get_task_dependencies(candidate)
+        for dep in dependencies:
+            if dep not in done:
+                done[dep] = is_done(dep)
+        if all(done[dep] for dep in dependencies):
+            bundle.append(candidate)
+    return bundle
+
+def get_bundle_tasks(task, pack, backlog_column_gid, done_column_gid):
+    """Runnable backlog tasks from the same pack group as `task`, including `task` itself"""
+    if DAEMON_SOCKET and backlog_column_gid == column_gids["Backlog"]:
+        return [task] + daemon_request('get_bundle', task_gid=task['gid'], group=pack['group'], max_tasks=pack['max'] - 1)
+    candidates = tasks_api_instance.get_tasks_for_section(backlog_column_gid, {"limit": 100, "opt_fields": "name,notes,created_at"})
+    candidates = [candidate for candidate in candidates if candidate['gid'] != task['gid']]
+    return [task] + select_bundle_tasks(candidates, pack['group'], pack['max'] - 1, lambda dep: is_task_done(dep, done_column_gid))
+
+def write_action(kind, task_gid, value):
+    """Batch API action for a ('notes' | 'move' | 'comment', task_gid, notes | section_gid | text) write"""
+    if kind == 'notes':
+        return {"relative_path": f"/tasks/{task_gid}", "method": "put", "data": {"notes": value}}
+    if kind == 'move':
+        return {"relative_path": f"/sections/{value}/addTask", "method": "post", "data": {"task": task_gid}}
+    return {"relative_path": f"/tasks/{task_gid}/stories", "method": "post", "data": {"text": value}}
+
+@backoff.on_exception(backoff.expo, (ApiException, RequestException), max_tries=5, on_backoff=count_retry)
+def batch_request(actions):
+    """Send actions ({"relative_path", "method", "data"}) to the Asana batch API, at most 10 per request"""
+    results = []
+    for i in range(0, len(actions), 10):
+        body = {"data": {"actions": actions[i:i + 10]}}
+        try:
+            results += list(batch_api_instance.create_batch_request(body, {}))
+        except ApiException as e:
+            print(f"Exception when calling BatchAPIApi->create_batch_request: {e}")
+            raise
+    return results
+
+def claim_tasks(tasks, worker_id, running_column_gid):
+    """Assign all tasks to this worker and move them to Running with a few batch requests.
+    Returns the gids of the tasks that are assigned to this worker afterwards."""
+    if DAEMON_SOCKET and running_column_gid == column_gids["Running"]:
+        return daemon_request('claim_bundle', tasks=[{'gid': task['gid'], 'notes': task['notes']} for task in tasks], worker_id=worker_id)
+    assignment = f"# Assigned to: {worker_id}"
+    actions = []
+    for task in tasks:
+        actions.append({"relative_path": f"/tasks/{task['gid']}", "method": "put",
+                        "data": {"notes": task['notes'].strip() + f"\n{assignment}"}})
+        actions.append({"relative_path": f"/sections/{running_column_gid}/addTask", "method": "post",
+                        "data": {"task": task['gid']}})
+    batch_request(actions)
+    results = batch_request([{"relative_path": f"/tasks/{task['gid']}", "method": "get",
+                              "options": {"fields": ["notes"]}} for task in tasks])
+    claimed = []
+    for task, result in zip(tasks, results):
+        if result.get('status_code') == 200 and result['body']['data']['notes'].strip().endswith(assignment):
+            claimed.append(task['gid'])
+    return claimed
+
+def check_bundle_status(task_gids, running_column_gid, stop_events, finished_event):
+    """Like check_task_status, but polls all tasks of a bundle with one batch request"""
+    interval_seconds = get_preemption_settings()['status_check_seconds']
+    while not finished_event.wait(interval_seconds):
+        try:
+            if DAEMON_SOCKET and running_column_gid == column_gids["Running"]:
+                sections = daemon_request('sections', task_gids=task_gids)
+                running = {gid: sections.get(gid) == running_column_gid for gid in task_gids}
+            else:
+                results = batch_request([{"relative_path": f"/tasks/{gid}", "method": "get",
+                                          "options": {"fields": ["memberships.section"]}} for gid in task_gids])
+                running = {gid: task_in_section(result['body']['data'], running_column_gid)
+                           for gid, result in zip(task_gids, results) if result.get('status_code') == 200}
+            for gid in task_gids:
+                if gid not in running or stop_events[gid].is_set():
+                    continue
+                if not running[gid]:
+                    stop_events[gid].set()
+                    print(f"Task {gid} was moved out of the Running column. Interrupting execution.")
+            print('.', end='')
+        except Exception as e:
+            print(f"Error checking bundle status: {e}")
+
+def run_bundle(tasks, column_gids, worker_id, parallel=1):
+    """Run a bundle of packed tasks with one claim, one status watcher and batched reporting.
+    Up to `parallel` tasks run at the same time, each in its own directory."""
+    print(f"Running bundle of {len(tasks)} experiments: {[task['name'] for task in tasks]}")
+    claimed = claim_tasks(tasks, worker_id, column_gids["Running"])
+    inc("experisana_claim_conflicts_total", len(tasks) - len(claimed))
+    tasks = [task for task in tasks if task['gid'] in claimed]
+    if not tasks:
+        print("All tasks of the bundle were assigned to other workers. Skipping.")
+        return False
+    for task in tasks:
+        record_queue_wait(task)
+
+    bundle_dir = os.path.join("/tmp", f"bundle_{datetime.now().strftime('%Y%m%d%H%M%S')}")
+    statuses, task_dirs, pending = {}, {}, []
+    for task in tasks:
+        task_dirs[task['gid']] = os.path.join(bundle_dir, f"task_{task['gid']}")
+        try:
+            if prepare_task_dir(task['gid'], task_dirs[task['gid']]):
+                pending.append(task)
+                continue
+        except Exception as e:
+            print(f"Exception when downloading attachments of {task['name']}: {e}")
+        os.makedirs(task_dirs[task['gid']], exist_ok=True)
+        with open(os.path.join(task_dirs[task['gid']], "experiment_logs.txt"), "w") as log_file:
+            log_file.write("Failed to download attachments\n")
+        statuses[task['gid']] = 'failed'
+
+    contexts = {task['gid']: extract_context_from_notes(task['notes']) for task in tasks}
+    cache_misses = {gid: lookup_cache(context, CACHE_SETTINGS)[1] for gid, context in contexts.items()}
+    started_at = time.time()
+
+    stop_events = {task['gid']: threading.Event() for task in tasks}
+    finished_event = threading.Event()
+    status_thread = threading.Thread(target=check_bundle_status, args=([task['gid'] for task in pending], column_gids["Running"], stop_events, finished_event))
+    status_thread.start()
+
+    running, returncodes = {}, {}
+    preemption = get_preemption_settings()
+    timeouts = {task['gid']: extract_timeout_from_notes(task['notes']) for task in tasks}
+    try:
+        while pending or running:
+            while pending and len(running) < parallel:
+                task = pending.pop(0)
+                if stop_events[task['gid']].is_set():
+                    # Moved out of Running while it waited for its turn
+                    with open(os.path.join(task_dirs[task['gid']], "experiment_logs.txt"), "w") as log_file:
+                        log_file.write("Not started: the task was moved out of the Running column\n")
+                    statuses[task['gid']] = 'interrupted'
+                    continue
+                log_file = open(os.path.join(task_dirs[task['gid']], "experiment_logs.txt"), "w")
+                print(f"Running command of {task['name']}: {get_command(task)}")
+                process = subprocess.Popen(get_command(task), shell=True, cwd=task_dirs[task['gid']], stdout=log_file, stderr=subprocess.STDOUT, start_new_session=True)
+                running[task['gid']] = (process, log_file, time.time())
+            for gid, (process, log_file, process_started_at) in list(running.items()):
+                if stop_events[gid].is_set():
+                    stop_process_group(process, preemption['signal'], preemption['grace_seconds'])
+                    statuses[gid] = 'interrupted'
+                elif timeouts[gid] and process.poll() is None and time.time() - process_started_at > 60 * timeouts[gid]:
+                    print(f"Task {gid} exceeded its timeout of {timeouts[gid]} minutes.")
+                    stop_process_group(process, preemption['signal'], preemption['grace_seconds'])
+                    statuses[gid] = 'timeout'
+                    returncodes[gid] = process.returncode
+                elif process.poll() is not None:
+                    statuses[gid] = 'succeeded' if process.returncode == 0 else 'failed'
+                    returncodes[gid] = process.returncode
+                else:
+                    continue
+                kill_process_group(process.pid)
+                observe("experisana_task_runtime_seconds", time.time() - process_started_at, status=statuses[gid])
+                log_file.close()
+                del running[gid]
+            time.sleep(1)
+    except Exception as e:
+        print(f"Exception during bundle execution: {e}")
+        for gid, (process, log_file, process_started_at) in running.items():
+            kill_process_group(process.pid)
+            log_file.close()
+        for task in tasks:
+            statuses.setdefault(task['gid'], 'failed')
+            if statuses[task['gid']] == 'interrupted':
+                statuses[task['gid']] = 'failed'
+    finished_event.set()
+    status_thread.join()
+
+    for gid, context in contexts.items():
+        try:
+            record_cache_usage(context, CACHE_SETTINGS, started_at, cache_misses[gid])
+        except Exception as e:
+            print(f"Exception when updating the cache index: {e}")
+
+    # Attach uploads/ (e.g. checkpoints of requeued tasks) before any task becomes visible in another column
+    for task in tasks:
+        upload_task_dir(task['gid'], task_dirs[task['gid']])
+
+    # Report all results with batched moves, notes and comments
+    writes = []
+    for task in tasks:
+        gid, status = task['gid'], statuses[task['gid']]
+        log_file_path = os.path.join(task_dirs[gid], "experiment_logs.txt")
+        if status in ('failed', 'timeout'):
+            notes = task['notes'].strip() + f"\n# Assigned to: {worker_id}"
+            retry, notes, reason = plan_retry(notes, worker_id, status, log_file_path, returncodes.get(gid))
+            print(f"Task {gid} {status} ({reason}). {'Requeueing it.' if retry else 'Not retrying.'}")
+            writes.append(('notes', gid, notes))
+            writes.append(('move', gid, column_gids["Backlog"] if retry else column_gids["Failed"]))
+        elif status == 'succeeded':
+            writes.append(('move', gid, column_gids["Done"]))
+        try:
+            comment_text, upload_full_log = format_log_comment(log_file_path, status)
+            if upload_full_log:
+                upload_log_to_task(gid, log_file_path)
+            writes.append(('comment', gid, comment_text))
+        except Exception as e:
+            print(f"Exception when reading log file of {task['name']}: {e}")
+    if DAEMON_SOCKET:
+        # The daemon updates its snapshot right away and batches the writes of all local workers
+        senders = {'notes': update_task_notes, 'move': move_task_to_column, 'comment': post_comment_to_task}
+        for kind, gid, value in writes:
+            senders[kind](gid, value)
+    else:
+        batch_request([write_action(*write) for write in writes])
+    return any(status != 'interrupted' for status in statuses.values())
+
+
+@backoff.on_exception(backoff.expo, (ApiException, RequestException), max_tries=5, on_backoff=count_retry)
 def move_task_to_column(task_gid, section_gid):
+    if DAEMON_SOCKET:
+        return daemon_request('move', task_gid=task_gid, section_gid=section_gid)
     opts = {
         'body': {
             "data": {
@@ -352,8 +900,11 @@ def move_task_to_column(task_gid, section_gid):
         print(f"Exception when calling SectionsApi->add_task_for_section: {e}")
         raise
 
-@backoff.on_exception(backoff.expo, (RequestException, subprocess.CalledProcessError), max_tries=5)
+@backoff.on_exception(backoff.expo, (RequestException, subprocess.CalledProcessError), max_tries=5, on_backoff=count_retry)
 def upload_log_to_task(task_gid, log_file_path):
+    if DAEMON_SOCKET:
+        return daemon_request('upload', task_gid=task_gid, path=os.path.abspath(log_file_path))
+    start = time.time()
     try:
         subprocess.run([
             'curl', '--request', 'POST',
@@ -365,12 +916,14 @@ def upload_log_to_task(task_gid, log_file_path):
             '--form', f'file=@{log_file_path}',
             '--form', f'parent={task_gid}'
         ], check=True)
+        inc("experisana_upload_bytes_total", os.path.getsize(log_file_path))
+        observe("experisana_upload_duration_seconds", time.time() - start)
     except subprocess.CalledProcessError as e:
         print(f"Exception when calling Asana API via curl: {e}")
         raise
 
-@backoff.on_exception(backoff.expo, (ApiException, RequestException), max_tries=5)
-def download_attachments(task_gid, download_dir):
+@backoff.on_exception(backoff.expo, (ApiException, RequestException), max_tries=5, on_backoff=count_retry)
+def download_attachments(task_gid, download_dir, skip_existing=False):
     opts = {
         'opt_fields': "download_url,name",
         'limit': 50
@@ -380,9 +933,14 @@ def download_attachments(task_gid, download_dir):
         for attachment in attachments:
             download_url = attachment['download_url']
             file_name = attachment['name']
+            if skip_existing and os.path.exists(os.path.join(download_dir, file_name)):
+                continue
+            start = time.time()
             response = requests.get(download_url)
             with open(os.path.join(download_dir, file_name), 'wb') as f:
                 f.write(response.content)
+            inc("experisana_download_bytes_total", len(response.content))
+            observe("experisana_download_duration_seconds", time.time() - start)
         return True
     except (ApiException, RequestException) as e:
         print(f"Exception when downloading attachments: {e}")
@@ -391,8 +949,10 @@ def download_attachments(task_gid, download_dir):
         print(f"Unexpected exception when downloading attachment: {e}")
     return False
 
-@backoff.on_exception(backoff.expo, (ApiException, RequestException), max_tries=5)
+@backoff.on_exception(backoff.expo, (ApiException, RequestException), max_tries=5, on_backoff=count_retry)
 def post_comment_to_task(task_gid, comment_text):
+    if DAEMON_SOCKET:
+        return daemon_request('comment', task_gid=task_gid, text=comment_text)
     body = {"data": {"text": comment_text}}
     try:
         stories_api_instance.create_story_for_task(body, int(task_gid), opts)
@@ -401,7 +961,7 @@ def post_comment_to_task(task_gid, comment_text):
         raise
 
 
-@backoff.on_exception(backoff.expo, (ApiException, RequestException), max_tries=5)
+@backoff.on_exception(backoff.expo, (ApiException, RequestException), max_tries=5, on_backoff=count_retry)
 def create_worker_task(worker_id):
     try:
         task_data = {
@@ -419,7 +979,7 @@ def create_worker_task(worker_id):
         print(f"Exception when calling TasksApi->create_task: {e}")
         raise
 
-@backoff.on_exception(backoff.expo, (ApiException, RequestException), max_tries=5)
+@backoff.on_exception(backoff.expo, (ApiException, RequestException), max_tries=5, on_backoff=count_retry)
 def delete_worker_task(task_gid):
     try:
         tasks_api_instance.delete_task(task_gid)
@@ -437,35 +997,218 @@ def maybe_shutdown(idle_since, worker_id, worker_task):
         return
     idle_seconds = (datetime.now() - idle_since).total_seconds()
     print(f"Idle for {idle_seconds} seconds. Shutting down after {shutdown_after_minutes} minutes of inactivity via '{shutdown_cmd}'")
-    if idle_seconds > 60 * shutdown_after_minutes:
+    if should_shut_down(idle_seconds, shutdown_after_minutes):
         print("Shutting down worker due to inactivity")
+        wait_for_uploads()
         delete_worker_task(worker_task['gid'])
         os.system(shutdown_cmd)
         exit(0)
 
-def main(worker_id=None):
+async def watch_task_status_async(client, task_gid, running_column_gid, stop_event, interval_seconds=15):
+    """Async version of check_task_status: sets stop_event once the task leaves the Running column"""
+    while not stop_event.is_set():
+        await asyncio.sleep(interval_seconds)
+        try:
+            task = await client.get_task(task_gid, "memberships.section")
+            if not task_in_section(task, running_column_gid):
+                stop_event.set()
+                print(f"Task {task_gid} was moved out of the Running column. Interrupting execution.")
+            else:
+                print('.', end='')
+        except Exception as e:
+            print(f"Error checking task status: {e}")
+
+async def get_backlog_task_async(client, backlog_column_gid, done_column_gid, worker_id=None):
+    """Async version of get_backlog_task: the status of all dependencies is fetched concurrently"""
+    tasks = await client.get_tasks_for_section(backlog_column_gid, "name,notes,created_at")
+    tasks = tasks[:CONFIG.get('scheduling', {}).get('candidates', 50)]
+    dependencies = sorted({dep for task in tasks for dep in get_task_dependencies(task) if dep.isdigit()})
+    results = await asyncio.gather(*[client.get_task(dep, "memberships.section") for dep in dependencies], return_exceptions=True)
+    done = {dep: not isinstance(result, Exception) and task_in_section(result, done_column_gid)
+            for dep, result in zip(dependencies, results)}
+    return select_runnable_task(tasks, lambda dep: done.get(dep, False), worker_id=worker_id)
+
+async def run_experiment_async(client, task, column_gids, worker_id):
+    """Async version of run_experiment: the job, the status watcher and all transfers run on one event loop"""
+    print(f"Running experiment: {task['name']}")
+    task_gid = task['gid']
+
+    # Try to assign the task to this worker
+    assignment = f"# Assigned to: {worker_id}"
+    await client.update_task(task_gid, {"notes": task['notes'].strip() + f"\n{assignment}"})
+    await client.add_task_to_section(column_gids["Running"], task_gid)
+    if not (await client.get_task(task_gid, "notes"))['notes'].strip().endswith(assignment):
+        print(f"Task {task_gid} was assigned to another worker. Skipping.")
+        inc("experisana_claim_conflicts_total")
+        return False
+    record_queue_wait(task)
+
+    # Create a new directory for the task and download all attachments at once
+    task_dir = os.path.join("/tmp", f"task_{task_gid}_{datetime.now().strftime('%Y%m%d%H%M%S')}")
+    os.makedirs(task_dir, exist_ok=True)
+    attachments = await client.get_attachments(task_gid, "name,download_url")
+    await asyncio.gather(*[client.download(attachment['download_url'], os.path.join(task_dir, attachment['name'])) for attachment in attachments])
+    unpack_all(task_dir)
+
+    context = extract_context_from_notes(task['notes'])
+    cache_misses = lookup_cache(context, CACHE_SETTINGS)[1]
+    started_at = time.time()
+
+    log_file_path = os.path.join(task_dir, "experiment_logs.txt")
+    print(f"Use the following command to watch logs:\n    watch tail {log_file_path}")
+    with open(log_file_path, "w") as log_file:
+        try:
+            stop_event = asyncio.Event()
+            preemption = get_preemption_settings()
+            timeout_min = extract_timeout_from_notes(task['notes'])
+            watcher = asyncio.create_task(watch_task_status_async(client, task_gid, column_gids["Running"], stop_event, preemption['status_check_seconds']))
+            process = await asyncio.create_subprocess_shell(get_command(task), cwd=task_dir, stdout=log_file, stderr=subprocess.STDOUT, start_new_session=True)
+            stopped = asyncio.create_task(stop_event.wait())
+            await asyncio.wait([asyncio.create_task(process.wait()), stopped], return_when=asyncio.FIRST_COMPLETED,
+                               timeout=timeout_min and 60 * timeout_min)
+            if process.returncode is None:
+                status = 'interrupted' if stop_event.is_set() else 'timeout'
+                try:
+                    os.killpg(process.pid, preemption['signal'])
+                    await asyncio.wait_for(process.wait(), timeout=preemption['grace_seconds'])
+                except (ProcessLookupError, asyncio.TimeoutError):
+                    pass
+            else:
+                status = 'succeeded' if process.returncode == 0 else 'failed'
+            kill_process_group(process.pid)
+            observe("experisana_task_runtime_seconds", time.time() - started_at, status=status)
+            stop_event.set()
+            watcher.cancel()
+
+            requeue = False
+            if status == 'succeeded':
+                await client.add_task_to_section(column_gids["Done"], task_gid)
+            elif status in ('failed', 'timeout'):
+                notes = (await client.get_task(task_gid, "notes"))['notes']
+                requeue, notes, reason = plan_retry(notes, worker_id, status, log_file_path, process.returncode)
+                print(f"Task {task_gid} {status} ({reason}). {'Requeueing it.' if requeue else 'Not retrying.'}")
+                await client.update_task(task_gid, {"notes": notes})
+                if not requeue:
+                    await client.add_task_to_section(column_gids["Failed"], task_gid)
+        except Exception as e:
+            print(f"Exception during experiment execution: {e}")
+            status = 'failed'
+            requeue = False
+            await client.add_task_to_section(column_gids["Failed"], task_gid)
+
+    try:
+        record_cache_usage(context, CACHE_SETTINGS, started_at, cache_misses)
+    except Exception as e:
+        print(f"Exception when updating the cache index: {e}")
+
+    # Post the log comment and upload all files concurrently
+    uploads = collect_uploads(task_dir)
+    comment_text, upload_full_log = format_log_comment(log_file_path, status)
+    if upload_full_log:
+        uploads.append(log_file_path)
+    results = await asyncio.gather(client.create_story(task_gid, comment_text),
+                                   *[client.upload_attachment(task_gid, path) for path in uploads], return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            print(f"Exception when reporting results: {result}")
+    if requeue:
+        # Requeue only now that the checkpoints in uploads/ are attached
+        await client.add_task_to_section(column_gids["Backlog"], task_gid)
+        print(f"Requeued task {task_gid} with its checkpoints attached.")
+    return status != 'interrupted'
+
+async def get_next_task_async(client, projects, worker_id=None):
+    """Async version of get_next_task"""
+    running_counts = {}
+    if len(projects) > 1:
+        columns = [get_project_columns(project['gid']) for project in projects]
+        running = await asyncio.gather(*[client.get_tasks_for_section(c["Running"], "gid") for c in columns])
+        running_counts = {project['gid']: len(tasks) for project, tasks in zip(projects, running)}
+    for project in fair_share_order(projects, running_counts):
+        columns = get_project_columns(project['gid'])
+        task = await get_backlog_task_async(client, columns["Backlog"], columns["Done"], worker_id)
+        if task:
+            inc("experisana_tasks_selected_total", project=project['gid'])
+            return columns, task
+    return None, None
+
+async def main_async(worker_id, worker_task, projects):
+    idle_since = datetime.now()
+    async with AsyncAsanaClient() as client:
+        while True:
+            try:
+                columns, task = await get_next_task_async(client, projects, worker_id)
+                if task:
+                    if await run_experiment_async(client, task, columns, worker_id):
+                        idle_since = datetime.now()
+                    else:
+                        print("Task was interrupted. Checking backlog again.")
+                else:
+                    maybe_shutdown(idle_since, worker_id, worker_task)
+                    await asyncio.sleep(5)
+                    inc("experisana_worker_idle_seconds_total", 5)
+            except Exception as e:
+                print(f"Unexpected error in main loop: {e}")
+                await asyncio.sleep(60)  # Sleep for 1 minute before retrying
+
+def main(worker_id=None, pipeline=False, daemon_socket=None, use_async=False, metrics_port=None, projects=None):
     worker_id = worker_id or get_or_create_worker_id()
+    # Boards to take tasks from, e.g. --projects "123:2,456:1" to give the first one two thirds of the pool
+    projects = get_projects(projects)
+    if len(projects) > 1:
+        weights = ", ".join(f"{project['gid']}: {project['weight']:g}" for project in projects)
+        print(f"Serving {len(projects)} projects with weights {weights}")
+    metrics_port = metrics_port or CONFIG.get('metrics', {}).get('port')
+    if metrics_port:
+        start_metrics_server(metrics_port)
+    if CONFIG.get('trace', {}).get('enabled', True):
+        trace.configure(worker_id, CONFIG.get('trace', {}).get('dir'), CONFIG.get('trace', {}).get('attach', False))
+    # Talk to the board via the host-local daemon if one is running
+    global DAEMON_SOCKET
+    daemon_socket = daemon_socket or CONFIG.get('daemon', {}).get('socket')
+    if daemon_socket and os.path.exists(daemon_socket):
+        print(f"Using board-sync daemon at {daemon_socket}")
+        DAEMON_SOCKET = daemon_socket
+    # In pipeline mode, downloads of the next task and uploads of the previous one overlap with the running job
+    pipeline = pipeline or CONFIG.get('pipeline', False)
     worker_task = create_worker_task(worker_id)
 
     if not column_gids:
         print("Failed to fetch column GIDs")
         return
 
+    if use_async:
+        # Single event loop instead of threads and blocking calls
+        try:
+            asyncio.run(main_async(worker_id, worker_task, projects))
+        except KeyboardInterrupt:
+            print("Exiting")
+            delete_worker_task(worker_task['gid'])
+            exit(0)
+        return
+
     idle_since = datetime.now()
     while True:
         try:
-            task = get_backlog_task(column_gids["Backlog"], column_gids["Done"])
+            columns, task = get_next_task(projects, worker_id)
             if task:
-                task_completed = run_experiment(task, column_gids, worker_id)
+                pack = extract_pack_from_notes(task['notes'])
+                if pack:
+                    bundle = get_bundle_tasks(task, pack, columns["Backlog"], columns["Done"])
+                    task_completed = run_bundle(bundle, columns, worker_id, parallel=pack['parallel'])
+                else:
+                    task_completed = run_experiment(task, columns, worker_id, pipeline=pipeline)
                 if task_completed:
                     idle_since = datetime.now()
                 else:
                     print("Task was interrupted. Checking backlog again.")
             else:
                 maybe_shutdown(idle_since, worker_id, worker_task)
-                time.sleep(5) 
+                time.sleep(5)
+                inc("experisana_worker_idle_seconds_total", 5)
         except KeyboardInterrupt:
             print("Exiting")
+            wait_for_uploads()
             delete_worker_task(worker_task['gid'])
             exit(0)
         except Exception as e:
@@ -10,8 +10,12 @@ setup(
         'python-dotenv',
         'requests',
         'backoff',
-        'PyYAML'
+        'PyYAML',
+        'aiohttp'
     ],
+    extras_require={
+        'zstd': ['zstandard'],
+    },
     entry_points={
         'console_scripts': [
             'experisana=experisana.cli:main',